@@ -2,24 +2,40 @@
 # coding: utf-8
 
 import argparse
+import array
+import atexit
+import bisect
+import collections
+import contextlib
 import datetime
+import errno
+import fnmatch
+import functools
 import glob
+import hashlib
+import heapq
 import itertools
 import json
 import logging
+import math
 import os
 import random
 import re
-import steam
-import subprocess
+import sqlite3
+import struct
 import sys
-
-import jinja2
-import xmltodict
-import yaml
+import threading
+import time
 
 
+ARTWORK_DEFAULT = 'Default'
 BREAK_LENGTH = 15
+CATALOG_FIELDS = (
+    'route', 'devstring', 'name', 'scenario_class', 'duration', 'start_datetime', 'service_name',
+    'formation_length',
+)
+CONVERTER_COMMAND = '.\\Serz.exe {bin}'
+CONVERTER_TIMEOUT = 60
 HIGH_TOLERANCE = 15
 IGNORED_ROUTES = (
     'Academy',
@@ -31,7 +47,28 @@ IGNORED_SCENARIO_CLASSES = (
     'eTutorialScenarioClass',
 )
 LOW_TOLERANCE = 15
+PARALLEL_FRAGMENTS = 256
+RECENTLY_DRIVEN_MODES = ('avoid', 'exclude')
+SCANNER_JOBS = 8
+SCENARIO_COPY_COLUMNS = (
+    'name', 'devstring', 'uuids', 'scenario_class', 'duration', 'start_datetime', 'service_name',
+    'vmax', 'formation_length',
+)
+SCENARIO_INDEXED_COLUMNS = ('duration', 'formation_length', 'scenario_class', 'start_datetime', 'vmax')
+SERVE_PORT = 8042
+SERVE_REFRESH_INTERVAL = 60
+SERVE_RESCAN_INTERVAL = 60 * 60
+SERZ_DEFINITION_SLOTS = 255
+SERZ_FLOAT_TYPES = {'sFloat32': 'f', 'sFloat64': 'd'}
+SERZ_MAGIC = b'SERZ'
+SERZ_VALUE_FORMATS = {
+    'bool': 'B', 'sInt8': 'b', 'sUInt8': 'B', 'sInt16': 'h', 'sUInt16': 'H', 'sInt32': 'i', 'sUInt32': 'I',
+    'sInt64': 'q', 'sUInt64': 'Q', 'sFloat32': 'f', 'sFloat64': 'd',
+}
 STEAM_API_KEY = ''
+STEAM_API_URL = 'https://api.steampowered.com'
+STEAM_PLAYTIME_TTL = 60 * 60
+STEAM_TIMEOUT = 5
 TEMPLATE_CONFIG = """
 # Automatically created by Railworks Dispatcher
 # See https://github.com/centralniak/railworks-dispatcher
@@ -40,72 +77,994 @@ TEMPLATE_CONFIG = """
 steam:
   profile: ~
   hours_two_weeks: 14
+  api_key: ~
+
+recently_driven:
+  days: 7
+  mode: avoid
+
+# devstrings of scenarios never to be used
+ignored_scenarios: []
+
+# only scenarios matching all of these are used, e.g. ['route=GEML*', 'date=1980..1999']
+filters: []
+
+# how scenarios are favoured when drawn, 0 turns a preference off
+sampling:
+  recency: 1
+  route_balance: 0.5
+  era: ~  # e.g. [1960, 1995]
+  era_weight: 4
+  duration: ~  # e.g. [30, 90]
+  duration_weight: 2
+
+# read Scenario.bin without unpacking it: true, false or ~ to do so only if the command cannot run
+converter:
+  native: ~
+  command: '.\\Serz.exe {bin}'
+  timeout: 60
+  jobs: 2
+
+# drivers getting a work order each from `dispatcher.py --batch`, e.g.
+#   - name: driver1
+#     orders: 2h  # or a number of work orders, left out the steam section below decides
+#     steam: {profile: driver1_on_steam, hours_two_weeks: 10}
+#     ignored_scenarios: []
+#     filters: ['route=GEML*']  # on top of the filters above
+#     share_scenarios: false  # whether scenarios given to other drivers in the batch may be used
+# other sections above can be given per driver as well
+profiles: []
 """
 
 
-class DriverInstruction(object):
-
-    data = None
-    start_datetime = None
+class ArtworkIndex(object):
+    """
+    Operator logos by route and date, as listed in artwork.yaml.
 
-    def __init__(self, data, start_datetime):
-        self.data = data
-        self.start_datetime = start_datetime
+    Periods of each route are kept sorted by their start, so the logo for a date is found
+    by bisecting the starts. Routes missing from artwork.yaml, and dates none of their
+    periods cover, fall back to the ARTWORK_DEFAULT periods.
+    """
 
-    @property
-    def arrival(self):
-        duration = int(float(self.data['Duration']['#text']))
-        seconds_after_start = float(self.data['DueTime']['#text'])
-        if not seconds_after_start or not duration or not self.start_datetime:
+    periods = None
+    starts = None
+
+    def __init__(self, periods):
+        """
+        periods: [start, until, logo] lists by route name, with dates as ordinals or None if open
+        """
+        self.periods = {}
+        self.starts = {}
+        for route_name, route_periods in periods.items():
+            route_periods = sorted(route_periods, key=lambda period: period[0] or 0)
+            self.periods[route_name] = route_periods
+            self.starts[route_name] = [period[0] or 0 for period in route_periods]
+
+    @classmethod
+    def from_config(cls, artwork):
+        """
+        Build the index from artwork.yaml as loaded by PyYAML
+        """
+        def to_ordinal(value):
+            if value is None:
+                return
+            if not isinstance(value, datetime.date):
+                value = datetime.date(*(int(part) for part in str(value).split('-')))
+            return value.toordinal()
+
+        return cls(dict(
+            (route_name, [
+                [to_ordinal(period.get('from')), to_ordinal(period.get('until')), period['logo']]
+                for period in route_periods or []
+            ])
+            for route_name, route_periods in (artwork or {}).items()
+        ))
+
+    def logo(self, route_name, date):
+        """
+        File name of the logo for a scenario on route_name starting at date, None if there is none
+        """
+        if date is None:
             return
-        arrival = self.start_datetime + datetime.timedelta(seconds=seconds_after_start - duration)
-        return arrival
+        ordinal = date.toordinal()
+        for name in (route_name, ARTWORK_DEFAULT):
+            starts = self.starts.get(name)
+            if not starts:
+                continue
+            position = bisect.bisect_right(starts, ordinal) - 1
+            if position < 0:
+                continue
+            until, logo = self.periods[name][position][1:]
+            if until is None or ordinal <= until:
+                return logo
+
+
+class BatchProfile(object):
+    """
+    A driver getting a work order in a --batch run, as listed under profiles in dispatcher.yaml.
+
+    Sections of the profile take the place of the top-level ones, except for filters that
+    apply on top of them and steam that is never shared. Every driver has a folder under
+    WorkOrders, with their own numbering and ledger, so recently driven scenarios are kept
+    per driver.
+    """
+
+    config = None
+    ledger = None
+    name = None
+    steam_lookup = None
+    work_orders_folder = None
+
+    def __init__(self, profile_config, config, work_orders_folder, index):
+        if not profile_config.get('name'):
+            raise DispatcherError('Every profile in dispatcher.yaml needs a name.')
+        self.name = str(profile_config['name'])
+        self.config = dict(config, steam=None)
+        self.config.update(profile_config)
+        self.config['filters'] = (config.get('filters') or []) + (profile_config.get('filters') or [])
+        self.work_orders_folder = os.path.join(work_orders_folder, re.sub(r'[^\w .-]', '_', self.name))
+        ensure_folder(self.work_orders_folder)
+        self.ledger = Ledger(os.path.join(self.work_orders_folder, 'ledger.sqlite'))
+        self.steam_lookup = get_steam_lookup(self.config['steam'], index)
+
+    def close(self):
+        self.ledger.close()
 
     @property
-    def departure(self):
-        seconds_after_start = float(self.data['DueTime']['#text'])
-        if not seconds_after_start:
+    def share_scenarios(self):
+        return bool(self.config.get('share_scenarios'))
+
+    def start(self):
+        if self.steam_lookup is not None:
+            self.steam_lookup.start()
+
+    def work_orders(self):
+        """
+        Work orders wanted as given to the command line: orders of the profile, or else minutes
+        missing from the planned Steam hours, None if there are none missing
+        """
+        if self.config.get('orders') is not None:
+            return str(self.config['orders'])
+        hours_planned = (self.config['steam'] or {}).get('hours_two_weeks')
+        if self.steam_lookup is None or not hours_planned:
+            return '1'
+        minutes_played = self.steam_lookup.minutes_played()
+        if minutes_played is None:
+            logging.warning('Unable to fetch data from steam for %s' % self.name)
+            return '1'
+        minutes_less = hours_planned * 60 - minutes_played
+        if minutes_less > 0:
+            return '%dm' % minutes_less
+
+
+class ContentScanner(object):
+    """
+    Finds RouteProperties.xml, ScenarioProperties.xml and .ap packages of all routes.
+
+    Route folders are walked with os.scandir in a thread pool, collecting mtime and size of
+    the files on the way. What was found in a route is kept in the index along with the mtimes
+    of the route folder, its Scenarios folder and every scenario folder, and a route where none
+    of them changed is not walked again. Replacing a file changes the mtime of its folder, but
+    editing it in place does not, such changes are only noticed with rescan.
+    """
+
+    index = None
+    jobs = None
+    rescan = None
+
+    def __init__(self, index, jobs=SCANNER_JOBS, rescan=False):
+        self.index = index
+        self.jobs = jobs
+        self.rescan = rescan
+
+    def scan(self, routes_folder):
+        """
+        Return paths of all ScenarioProperties.xml files, loose and packed, and a dict
+        with (mtime_ns, size) of all loose RouteProperties.xml and ScenarioProperties.xml
+        """
+        known = {} if self.rescan else self.index.folder_listings()
+        listings = {}
+        walks = []
+        try:
+            route_entries = [entry for entry in os.scandir(routes_folder) if entry.is_dir()]
+        except OSError:
+            route_entries = []
+        for entry in route_entries:
+            signature = self._signature(entry)
+            listing = known.get(entry.path)
+            if listing is not None and listing[0] == signature:
+                listings[entry.path] = listing
+            else:
+                walks.append((entry.path, signature))
+
+        if walks:
+            profiler.tally('route walked', len(walks))
+            if len(walks) > 1 and self.jobs > 1:
+                import concurrent.futures
+                with concurrent.futures.ThreadPoolExecutor(self.jobs) as executor:
+                    walked = list(executor.map(self._walk, [path for path, signature in walks]))
+            else:
+                walked = [self._walk(path) for path, signature in walks]
+            for (path, signature), listing in zip(walks, walked):
+                listings[path] = (signature, listing)
+            self.index.record_folder_listings(dict((path, listings[path]) for path, signature in walks))
+        self.index.forget_folders(set(known) - set(listings))
+
+        stats = {}
+        archives = []
+        for signature, listing in listings.values():
+            stats.update((path, tuple(stat)) for path, stat in listing['files'].items())
+            archives.extend(listing['archives'])
+        scenario_xmls = [path for path in stats if os.path.basename(path) == 'ScenarioProperties.xml']
+        pattern = os.path.join(routes_folder, '*', 'Scenarios', '*', 'ScenarioProperties.xml')
+        scenario_xmls.extend(content.packed(pattern, archives, loose=scenario_xmls))
+        return sorted(scenario_xmls), stats
+
+    @staticmethod
+    def _signature(route_entry):
+        scenarios_folder = os.path.join(route_entry.path, 'Scenarios')
+        try:
+            scenarios_mtime = os.stat(scenarios_folder).st_mtime_ns
+            scenario_mtimes = sorted(
+                (entry.name, entry.stat().st_mtime_ns) for entry in os.scandir(scenarios_folder) if entry.is_dir())
+        except OSError:
+            scenarios_mtime = scenario_mtimes = None
+        if scenario_mtimes is not None:
+            scenario_mtimes = hashlib.sha1(json.dumps(scenario_mtimes).encode('utf-8')).hexdigest()
+        return [route_entry.stat().st_mtime_ns, scenarios_mtime, scenario_mtimes]
+
+    @staticmethod
+    def _walk(route_folder):
+        files = {}
+        archives = []
+        scenarios_folder = None
+        for entry in os.scandir(route_folder):
+            name = os.path.normcase(entry.name)
+            if name == os.path.normcase('Scenarios') and entry.is_dir():
+                scenarios_folder = entry.path
+            elif name == os.path.normcase('RouteProperties.xml') and entry.is_file():
+                stat = entry.stat()
+                files[os.path.join(route_folder, 'RouteProperties.xml')] = (stat.st_mtime_ns, stat.st_size)
+            elif name.endswith('.ap') and entry.is_file():
+                archives.append(entry.path)
+
+        if scenarios_folder is not None:
+            for scenario_entry in os.scandir(scenarios_folder):
+                if not scenario_entry.is_dir():
+                    continue
+                for entry in os.scandir(scenario_entry.path):
+                    if os.path.normcase(entry.name) == os.path.normcase('ScenarioProperties.xml') and entry.is_file():
+                        stat = entry.stat()
+                        path = os.path.join(scenario_entry.path, 'ScenarioProperties.xml')
+                        files[path] = (stat.st_mtime_ns, stat.st_size)
+        return {'files': files, 'archives': sorted(archives)}
+
+
+class ContentSource(object):
+    """
+    Reads Railworks content from loose files and from .ap packages alike.
+
+    A member of an .ap (zip) package is addressed by the path it would have if the package
+    was unpacked into its own folder, so the rest of dispatcher does not need to know where
+    a file comes from. Loose files always take precedence over packed ones. The central
+    directory of each package is read once per process and members are streamed from
+    the package on demand.
+    """
+
+    archives = None
+    folders = None
+    pid = None
+
+    def __init__(self):
+        self.reset()
+
+    def exists(self, path):
+        return os.path.isfile(path) or self._member(path) is not None
+
+    def extract(self, path):
+        """
+        Unpack a packed file to its loose path, return whether there was anything to unpack
+        """
+        member = self._member(path)
+        if member is None:
+            return False
+        ensure_folder(os.path.dirname(path))
+        with self.open(path) as source, open(path, 'wb') as target:
+            while True:
+                chunk = source.read(1024 * 1024)
+                if not chunk:
+                    break
+                target.write(chunk)
+        return True
+
+    def packed(self, pattern, archives, loose=()):
+        """
+        Paths of files in the given packages matching pattern, except for those present as loose files
+        """
+        loose = set(os.path.normcase(path) for path in loose)
+        pattern = os.path.normcase(pattern)
+        depth = pattern.count(os.sep)
+        paths = []
+        for archive in archives:
+            folder = os.path.dirname(archive)
+            for info in self._archive(archive)[1].values():
+                path = os.path.join(folder, *info.filename.split('/'))
+                normalized = os.path.normcase(path)
+                # fnmatch lets * match across folders, unlike glob
+                if normalized.count(os.sep) == depth and fnmatch.fnmatch(normalized, pattern) \
+                        and normalized not in loose:
+                    paths.append(path)
+        return paths
+
+    def open(self, path):
+        """
+        Binary file object reading path from disk or, if there is no such loose file, from a package
+        """
+        if os.path.isfile(path):
+            return open(path, 'rb')
+        member = self._member(path)
+        if member is None:
+            raise FileNotFoundError(errno.ENOENT, os.strerror(errno.ENOENT), path)
+        archive, info = member
+        return self._archive(archive)[0].open(info)
+
+    def reset(self):
+        if self.pid == os.getpid():
+            for zip_file, members in self.archives.values():
+                if zip_file is not None:
+                    zip_file.close()
+        self.archives = {}
+        self.folders = {}
+        self.pid = os.getpid()
+
+    def stat(self, path):
+        """
+        (mtime_ns, size) of path, packed files take mtime of their package, None if there is no such file
+        """
+        try:
+            stat = os.stat(path)
+            return stat.st_mtime_ns, stat.st_size
+        except OSError:
+            pass
+        member = self._member(path)
+        if member is None:
             return
-        return self.start_datetime + datetime.timedelta(seconds=seconds_after_start)
+        archive, info = member
+        return os.stat(archive).st_mtime_ns, info.file_size
+
+    def _archive(self, archive):
+        # zip files opened before a fork would share their file offset with the parent
+        if self.pid != os.getpid():
+            self.reset()
+        opened = self.archives.get(archive)
+        if opened is None:
+            import zipfile
+            with profiler.phase('read .ap directory'):
+                try:
+                    zip_file = zipfile.ZipFile(archive)
+                    members = dict(
+                        (os.path.normcase(os.path.join(*info.filename.split('/'))), info)
+                        for info in zip_file.infolist() if not info.is_dir()
+                    )
+                except (zipfile.BadZipFile, OSError) as exc:
+                    # a broken package is taken for an empty one, the rest of the content is still usable
+                    logging.warning('Unable to read package %s: %s' % (archive, exc))
+                    profiler.count('broken package')
+                    zip_file, members = None, {}
+            opened = self.archives[archive] = (zip_file, members)
+        return opened
+
+    def _member(self, path):
+        """
+        (archive, ZipInfo) of the package holding path, looked up in all folders above it
+        up to the route folder, Content/Routes/<route>
+        """
+        folder = os.path.dirname(path)
+        while True:
+            archives = self.folders.get(folder)
+            if archives is None:
+                archives = self.folders[folder] = sorted(glob.glob(os.path.join(glob.escape(folder), '*.ap')))
+            if archives:
+                name = os.path.normcase(os.path.relpath(path, folder))
+                for archive in archives:
+                    info = self._archive(archive)[1].get(name)
+                    if info is not None:
+                        return archive, info
+            parent = os.path.dirname(folder)
+            if parent == folder or os.path.normcase(os.path.basename(parent)) == os.path.normcase('Routes'):
+                return
+            folder = parent
+
+
+class Converter(object):
+    """
+    Unpacks Scenario.bin to Scenario.xml by running an external converter, Serz.exe by default.
 
-    @property
-    def extra(self):
-        operation = self.data['Operation']['#text'].lower()
-        if operation != 'Default':
-            return getattr(self, 'operation_' + operation)
+    Conversions run in a bounded thread pool so that upcoming scenarios can be unpacked
+    ahead of the selection loop. The command is a format string with {bin} and {xml}
+    placeholders (paths relative to the Railworks folder), so any stand-in producing
+    Scenario.xml can be used instead of Serz.exe. Failed conversions are remembered by
+    mtime and size of Scenario.bin and not attempted again until the file changes.
 
-    @property
-    def location(self):
+    With native on, Scenario.bin in the Serz format is left to SerzReader and only
+    converted if SerzReader fails to read it.
+    """
+
+    command = None
+    executor = None
+    failures = None
+    native = None
+    new_failures = None
+    railworks_folder = None
+    timeout = None
+
+    def __init__(self, railworks_folder, command=CONVERTER_COMMAND, timeout=CONVERTER_TIMEOUT, jobs=1,
+                 failures=None, native=False):
+        self.railworks_folder = railworks_folder
+        self.native = native
+        self.command = command
+        self.timeout = timeout
+        self.jobs = max(jobs, 1)
+        self.failures = dict(failures or {})
+        self.new_failures = {}
+
+    def close(self):
+        if self.executor is not None:
+            # conversions submitted ahead and not started yet are not needed anymore
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def convert(self, xml_detailed):
+        """
+        Create given Scenario.xml from the neighbouring Scenario.bin, return whether it succeeded
+        """
+        import shlex
+        import subprocess
+
+        xml_bin = xml_detailed[:-len('.xml')] + '.bin'
+        signature = content.stat(xml_bin)
+        if signature is None:
+            profiler.count('missing Scenario.xml')
+            return False
+        if self.failed_before(xml_detailed):
+            profiler.count('conversion failed before')
+            return False
+
+        command = self.command.format(bin=self._relative(xml_bin), xml=self._relative(xml_detailed))
+        if os.name != 'nt':
+            command = shlex.split(command)
         try:
-            return self.data['DisplayName']['#text']
-        except TypeError:
-            logging.debug('Unable to fetch driver instruction location')
-            logging.debug(json.dumps(self.data, indent=4))
-            return ''
+            with profiler.phase('convert Scenario.bin') as parsed_bytes:
+                parsed_bytes[0] = signature[1]
+                # the converter only reads loose files, packed Scenario.bin is unpacked next to Scenario.xml
+                if not os.path.isfile(xml_bin):
+                    content.extract(xml_bin)
+                subprocess.check_output(
+                    command, cwd=self.railworks_folder, stderr=subprocess.STDOUT, timeout=self.timeout)
+            if not os.path.isfile(xml_detailed):
+                raise OSError('Converter did not create %s' % xml_detailed)
+        except (OSError, subprocess.SubprocessError) as exc:
+            logging.warning('Unable to convert %s: %s' % (xml_bin, exc))
+            profiler.count('converter error')
+            self.failures[xml_bin] = signature
+            self.new_failures[xml_bin] = signature + (str(exc),)
+            return False
+        return True
 
-    @property
-    def operation_addtoback(self):
-        cars = self.data['RailVehicleNumber']['e']
-        if not isinstance(cars, list):
-            cars = [cars]
-        return 'Attach {0}'.format(', '.join([c['#text'] for c in cars]))
+    def failed_before(self, xml_detailed):
+        """
+        Whether converting the neighbouring Scenario.bin failed before and it did not change since
+        """
+        xml_bin = xml_detailed[:-len('.xml')] + '.bin'
+        return xml_bin in self.failures and self.failures[xml_bin] == content.stat(xml_bin)
+
+    def fallback(self, xml_detailed):
+        """
+        Convert Scenario.bin that was read natively but could not be made sense of,
+        return whether it succeeded
+        """
+        if not self.native or content.exists(xml_detailed):
+            return False
+        if not is_serz(xml_detailed[:-len('.xml')] + '.bin'):
+            return False
+        return self.convert(xml_detailed)
+
+    def submit(self, xml_detailed):
+        """
+        Schedule conversion of Scenario.xml if needed, return None if it already exists
+        or Scenario.bin can be read as it is
+        """
+        if content.exists(xml_detailed):
+            return
+        if self.native and is_serz(xml_detailed[:-len('.xml')] + '.bin'):
+            return
+        if self.executor is None:
+            import concurrent.futures
+            self.executor = concurrent.futures.ThreadPoolExecutor(self.jobs)
+        return self.executor.submit(self.convert, xml_detailed)
 
-    @property
-    def operation_dropoffrailvehicle(self):
-        cars = self.data['RailVehicleNumber']['e']
-        if not isinstance(cars, list):
-            cars = [cars]
-        return 'Detach {0}'.format(', '.join([c['#text'] for c in cars]))
+    def _relative(self, path):
+        return path.replace(self.railworks_folder, '').strip(os.sep)
 
-    @property
-    def stopping(self):
+
+class DispatcherError(Exception):
+    """
+    A work order cannot be put together, the message is meant for the user
+    """
+
+
+class DispatcherService(object):
+    """
+    Keeps the scenario index hot for `dispatcher.py serve` and answers a local HTTP/JSON API.
+
+    Route folders are scanned again every refresh_interval seconds in the background, only
+    changed ones are walked, and all of them are walked every rescan_interval seconds. Work
+    orders are put together one at a time under a lock, which also keeps their numbers in
+    order, and summaries of loaded scenarios are shared by all of them, so no scenario is
+    parsed twice while the service runs.
+    """
+
+    artwork = None
+    config = None
+    converter = None
+    lock = None
+    refreshed = None
+    summaries = None
+
+    def __init__(self, railworks_folder, jobs=1, refresh_interval=SERVE_REFRESH_INTERVAL,
+                 rescan_interval=SERVE_RESCAN_INTERVAL):
+        self.railworks_folder = railworks_folder
+        self.jobs = jobs
+        self.refresh_interval = refresh_interval
+        self.rescan_interval = rescan_interval
+        self.routes_folder = os.path.join(railworks_folder, 'Content', 'Routes')
+        self.work_orders_folder = os.path.join(railworks_folder, 'WorkOrders')
+        ensure_folder(self.work_orders_folder)
+        self.cache_folder = os.path.join(railworks_folder, 'dispatcher.cache')
+        self.data_folder = os.path.join(os.path.abspath(os.path.dirname(__file__)), 'Dispatcher')
+        self.index_path = os.path.join(railworks_folder, 'dispatcher.sqlite')
+        self.ledger_path = os.path.join(self.work_orders_folder, 'ledger.sqlite')
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.summaries = {}
+
+    def close(self):
+        self.stopped.set()
+        if self.converter is not None:
+            self.converter.close()
+
+    def refresh(self, rescan=False):
+        """
+        Reload dispatcher.yaml if it changed and bring the index up to date with the route folders
+        """
+        with self.lock:
+            # routes and packages may have changed since they were read
+            routes.clear()
+            content.reset()
+            index = ScenarioIndex(self.index_path)
+            try:
+                self.config = load_config(ensure_config_present(self.railworks_folder), index)
+                self.artwork = load_artwork(os.path.join(self.data_folder, 'artwork.yaml'), index)
+                if self.converter is None:
+                    self.converter = get_converter(self.railworks_folder, self.config, index)
+                scenario_xmls, stats = ContentScanner(index, rescan=rescan).scan(self.routes_folder)
+                index.refresh(scenario_xmls, ignored_routes=IGNORED_ROUTES, stats=stats)
+            finally:
+                index.close()
+            self.refreshed = time.time()
+
+    def refresh_forever(self):
+        rescanned = time.time()
+        while not self.stopped.wait(self.refresh_interval):
+            # files edited in place are only noticed by walking all route folders
+            rescan = time.time() - rescanned >= self.rescan_interval
+            try:
+                self.refresh(rescan=rescan)
+            except Exception:
+                logging.exception('Unable to refresh the scenario index')
+            if rescan:
+                rescanned = time.time()
+
+    def scenarios(self, expressions=()):
+        """
+        Catalog rows of indexed scenarios matching expressions
+        """
+        index = ScenarioIndex(self.index_path)
         try:
-            return (
-                self.data['PickingUp']['#text'] == '1' and
-                self.data['Waypoint']['#text'] == '0') \
-                and self.data['MinSpeed']['#text'] == '0'
-        except KeyError:
+            scenario_filter = get_scenario_filter(self.config, expressions)
+            return [catalog_row(record) for record in index.iter_records(scenario_filter)]
+        finally:
+            index.close()
+
+    def serve(self, host, port):
+        import http.server
+
+        service = self
+
+        class Handler(http.server.BaseHTTPRequestHandler):
+
+            def do_GET(self):
+                path, _, query = self.path.partition('?')
+                if path == '/status':
+                    self.send_json(200, service.status())
+                elif path == '/scenarios':
+                    import urllib.parse
+                    expressions = urllib.parse.parse_qs(query).get('filter', [])
+                    self.handle_api(service.scenarios, expressions)
+                elif path.startswith('/work-orders/'):
+                    self.send_work_order(path[len('/work-orders/'):])
+                else:
+                    self.send_json(404, {'error': 'Not found.'})
+
+            def do_POST(self):
+                if self.path != '/orders':
+                    self.send_json(404, {'error': 'Not found.'})
+                    return
+                try:
+                    length = int(self.headers.get('Content-Length') or 0)
+                    request = json.loads(self.rfile.read(length).decode('utf-8') or '{}')
+                except ValueError:
+                    self.send_json(400, {'error': 'The request should be a JSON object.'})
+                    return
+                self.handle_api(service.work_order, request)
+
+            def handle_api(self, method, *args):
+                try:
+                    self.send_json(200, method(*args))
+                except DispatcherError as exc:
+                    self.send_json(400, {'error': str(exc)})
+                except Exception:
+                    logging.exception('Unable to handle %s', self.path)
+                    self.send_json(500, {'error': 'Something went wrong, see dispatcher.log for details.'})
+
+            def log_message(self, message_format, *args):
+                logging.debug('%s %s' % (self.address_string(), message_format % args))
+
+            def send_json(self, status, data):
+                self.send_body(status, 'application/json', json.dumps(data).encode('utf-8'))
+
+            def send_body(self, status, content_type, body):
+                self.send_response(status)
+                self.send_header('Content-Type', content_type)
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def send_work_order(self, name):
+                if not re.match(r'^\d+\.html$', name):
+                    self.send_json(404, {'error': 'Not found.'})
+                    return
+                try:
+                    with open(os.path.join(service.work_orders_folder, name), 'rb') as f:
+                        body = f.read()
+                except IOError:
+                    self.send_json(404, {'error': 'Not found.'})
+                    return
+                self.send_body(200, 'text/html; charset=utf-8', body)
+
+        self.refresh()
+        threading.Thread(target=self.refresh_forever, name='refresh', daemon=True).start()
+        server = http.server.ThreadingHTTPServer((host, port), Handler)
+        print('Serving work orders on http://%s:%d/, press Ctrl+C to stop.' % server.server_address[:2])
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            self.close()
+
+    def status(self):
+        index = ScenarioIndex(self.index_path)
+        try:
+            scenarios = index.connection.execute('SELECT COUNT(*) FROM scenarios').fetchone()[0]
+        finally:
+            index.close()
+        return {
+            'refreshed': datetime.datetime.fromtimestamp(self.refreshed).isoformat() if self.refreshed else None,
+            'scenarios': scenarios,
+            'loaded': len(self.summaries),
+        }
+
+    def work_order(self, request):
+        """
+        Put together and render a work order for a request such as {"orders": "2h", "filters": [...], "seed": 1}
+        """
+        if not isinstance(request, dict):
+            raise DispatcherError('The request should be a JSON object.')
+        filters = request.get('filters') or []
+        if not isinstance(filters, list) or not all(isinstance(expression, str) for expression in filters):
+            raise DispatcherError('filters should be a list of strings.')
+        seed = request.get('seed')
+        if seed is not None and (not isinstance(seed, int) or isinstance(seed, bool)):
+            raise DispatcherError('seed should be a whole number.')
+        needed = parse_work_orders(request.get('orders', '1'))
+        rng = random.Random(seed)
+
+        with self.lock:
+            index = ScenarioIndex(self.index_path)
+            ledger = Ledger(self.ledger_path)
+            try:
+                scenario_filter = get_scenario_filter(self.config, filters)
+                recently_driven, exclude_recent = get_recently_driven(self.config, ledger)
+                is_candidate = get_candidate_check(
+                    self.config.get('ignored_scenarios') or [], recently_driven, exclude_recent)
+                candidates = [record for record in index.records(scenario_filter) if is_candidate(record)]
+                if not candidates:
+                    raise DispatcherError('No scenarios match the filters. Sorry.')
+                weight = get_sampling_weight(self.config.get('sampling') or {}, candidates, ledger.last_driven())
+                try:
+                    orders = select_orders(
+                        candidates, needed, index, converter=self.converter, scenario_filter=scenario_filter,
+                        recently_driven=recently_driven, weight=weight, rng=rng, jobs=self.jobs,
+                        summaries=self.summaries
+                    )
+                finally:
+                    index.record_conversion_failures(self.converter.new_failures)
+                if not orders:
+                    raise DispatcherError('Not able to generate any scenario meeting your requirements. Sorry.')
+                html_path = write_work_order(
+                    orders, ledger, self.work_orders_folder, self.data_folder, self.cache_folder, self.jobs,
+                    self.artwork)
+            finally:
+                ledger.close()
+                index.close()
+
+        html_name = os.path.basename(html_path)
+        return {
+            'number': int(html_name[:-len('.html')]),
+            'path': html_path,
+            'url': '/work-orders/%s' % html_name,
+            'orders': [
+                {'devstring': order.devstring, 'name': order.name, 'duration': order.duration}
+                for order in orders
+            ],
+        }
+
+
+class DriverInstruction(object):
+    """
+    A single timetable row of the player service, as handed to the template
+    """
+
+    __slots__ = ('arrival', 'departure', 'extra', 'location', 'stopping')
+
+    def __init__(self, location, extra, arrival, departure, stopping):
+        self.arrival = arrival
+        self.departure = departure
+        self.extra = extra
+        self.location = location
+        self.stopping = stopping
+
+
+class DurationSolver(object):
+    """
+    Picks a random set of scenarios whose total duration, including BREAK_LENGTH between
+    each two of them, lies within the requested span, both ends included.
+
+    Scenarios are bucketed by cost (duration plus break) and taken from each bucket in
+    the order they were given, so the caller decides which ones are preferred. Per cost only as many copies as
+    could possibly fit the span take part in the subset sum, so its size depends on the
+    span rather than on the size of the library. Reachable sums are kept as integer bitsets
+    for every suffix of a shuffled item list, which makes it possible to tell at once whether
+    the span can be met at all, and then to walk the list taking or skipping items at random
+    without ever ending up in a dead end.
+    """
+
+    buckets = None
+    high = None
+    low = None
+    rng = None
+
+    def __init__(self, records, span, rng=random):
+        # every scenario costs its duration plus a break, so the sum of costs carries one break too many
+        self.low, self.high = span[0] + BREAK_LENGTH, span[1] + BREAK_LENGTH
+        self.rng = rng
+        self.buckets = {}
+        for record in records:
+            cost = record.duration + BREAK_LENGTH
+            if cost <= self.high:
+                self.buckets.setdefault(cost, []).append(record)
+            else:
+                profiler.count('overshoot')
+        # records are popped from the end
+        for bucket in self.buckets.values():
+            bucket.reverse()
+
+    def solve(self, total=0):
+        """
+        Return a random list of records which brings total, the durations plus breaks of
+        records picked before, inside the span, or None if there is no such list. Returned
+        records will not be considered again.
+        """
+        limit = self.high - total
+        if limit < 0:
+            return
+
+        items = []
+        for cost, bucket in self.buckets.items():
+            items.extend([cost] * min(len(bucket), limit // cost))
+        self.rng.shuffle(items)
+
+        # reachable[i] has bit n set if n minutes can be made of items[i:]
+        mask = (1 << (limit + 1)) - 1
+        reachable = [1]
+        for cost in reversed(items):
+            reachable.append((reachable[-1] | (reachable[-1] << cost)) & mask)
+        reachable.reverse()
+
+        if not self._fits(reachable[0], total):
+            return
+
+        chosen_costs = []
+        for i, cost in enumerate(items):
+            can_take = self._fits(reachable[i + 1], total + cost)
+            can_skip = self._fits(reachable[i + 1], total)
+            if can_take and (not can_skip or self.rng.random() < 0.5):
+                total += cost
+                chosen_costs.append(cost)
+
+        return [self.buckets[cost].pop() for cost in chosen_costs]
+
+    def _fits(self, reachable, total):
+        lowest = max(self.low - total, 0)
+        highest = self.high - total
+        if highest < lowest:
             return False
+        return (reachable >> lowest) & ((1 << (highest - lowest + 1)) - 1) != 0
+
+
+class Ledger(object):
+    """
+    Append-only history of generated work orders, kept in the WorkOrders folder.
+
+    Records the number, time and scenario devstrings of every work order, so that the
+    next number and the recently driven scenarios are known without reading old HTML.
+    """
+
+    connection = None
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS work_orders (
+            number INTEGER PRIMARY KEY,
+            created REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS work_order_scenarios (
+            number INTEGER NOT NULL REFERENCES work_orders (number),
+            devstring TEXT NOT NULL,
+            created REAL NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS work_order_scenarios_created ON work_order_scenarios (created, devstring);
+        CREATE INDEX IF NOT EXISTS work_order_scenarios_devstring ON work_order_scenarios (devstring, created);
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.executescript(self.SCHEMA)
+
+    def append(self, number, devstrings, created=None):
+        created = created or time.time()
+        with self.connection:
+            self.connection.execute('INSERT INTO work_orders (number, created) VALUES (?, ?)', (number, created))
+            self.connection.executemany(
+                'INSERT INTO work_order_scenarios (number, devstring, created) VALUES (?, ?, ?)',
+                [(number, devstring, created) for devstring in devstrings]
+            )
+
+    def close(self):
+        self.connection.close()
+
+    def driven_since(self, timestamp):
+        """
+        Devstrings of all scenarios put in work orders created after timestamp
+        """
+        return set(row[0] for row in self.connection.execute(
+            'SELECT DISTINCT devstring FROM work_order_scenarios WHERE created >= ?', (timestamp,)))
+
+    def last_driven(self):
+        """
+        Time each scenario was last put in a work order, by devstring
+        """
+        return dict(self.connection.execute(
+            'SELECT devstring, MAX(created) FROM work_order_scenarios GROUP BY devstring'))
+
+    def last_number(self):
+        """
+        Number of the most recent work order or None if there is none in the ledger yet
+        """
+        return self.connection.execute('SELECT MAX(number) FROM work_orders').fetchone()[0]
+
+
+class Profiler(object):
+    """
+    Collects wall time, call count and bytes parsed per phase of a dispatcher run,
+    together with counters of the reasons scenarios were skipped for and tallies of
+    anything else worth counting, such as cache hits.
+    """
+
+    counters = None
+    lock = None
+    phases = None
+    tallies = None
+
+    def __init__(self):
+        self.counters = collections.Counter()
+        self.lock = threading.Lock()
+        self.phases = collections.OrderedDict()
+        self.tallies = collections.Counter()
+
+    def count(self, reason, n=1):
+        """
+        Count a scenario skipped for the given reason
+        """
+        with self.lock:
+            self.counters[reason] += n
+
+    def merge(self, snapshot):
+        """
+        Add up a snapshot taken in another process
+        """
+        for name, (calls, seconds, parsed_bytes) in snapshot['phases'].items():
+            self._add(name, calls, seconds, parsed_bytes)
+        for reason, n in snapshot['counters'].items():
+            self.count(reason, n)
+        for name, n in snapshot['tallies'].items():
+            self.tally(name, n)
+
+    @contextlib.contextmanager
+    def phase(self, name):
+        """
+        Time the block as the given phase, it may yield bytes parsed via the returned list
+        """
+        parsed_bytes = [0]
+        started = time.perf_counter()
+        try:
+            yield parsed_bytes
+        finally:
+            self._add(name, 1, time.perf_counter() - started, parsed_bytes[0])
+
+    def report(self):
+        lines = ['%-32s %8s %10s %12s' % ('Phase', 'Calls', 'Seconds', 'Bytes')]
+        for name, (calls, seconds, parsed_bytes) in self.phases.items():
+            lines.append('%-32s %8d %10.3f %12d' % (name, calls, seconds, parsed_bytes))
+        if self.counters:
+            lines.append('')
+            lines.append('%-32s %8s' % ('Skipped scenarios', 'Count'))
+            for reason, n in sorted(self.counters.items()):
+                lines.append('%-32s %8d' % (reason, n))
+        if self.tallies:
+            lines.append('')
+            lines.append('%-32s %8s' % ('Counters', 'Count'))
+            for name, n in sorted(self.tallies.items()):
+                lines.append('%-32s %8d' % (name, n))
+        return '\n'.join(lines)
+
+    def reset(self):
+        with self.lock:
+            self.counters.clear()
+            self.phases.clear()
+            self.tallies.clear()
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'phases': dict((name, list(values)) for name, values in self.phases.items()),
+                'counters': dict(self.counters),
+                'tallies': dict(self.tallies),
+            }
+
+    def tally(self, name, n=1):
+        """
+        Count anything but skipped scenarios
+        """
+        with self.lock:
+            self.tallies[name] += n
+
+    def _add(self, name, calls, seconds, parsed_bytes):
+        with self.lock:
+            values = self.phases.setdefault(name, [0, 0.0, 0])
+            values[0] += calls
+            values[1] += seconds
+            values[2] += parsed_bytes
 
 
 class Route(object):
@@ -113,7 +1072,13 @@ class Route(object):
     data = None
 
     def __init__(self, xml):
-        self.data = xmltodict.parse(open(xml, encoding='utf-8').read())['cRouteProperties']
+        import xmltodict
+
+        with profiler.phase('parse RouteProperties.xml') as parsed_bytes:
+            with content.open(xml) as f:
+                data = f.read()
+            parsed_bytes[0] = len(data)
+            self.data = xmltodict.parse(data)['cRouteProperties']
 
     @property
     def name(self):
@@ -126,17 +1091,49 @@ class Route(object):
         ]
 
 
+class RouteRegistry(object):
+    """
+    Process-wide registry of routes, so that each RouteProperties.xml is parsed only once
+    and all scenarios of a route share the same Route instance
+    """
+
+    routes = None
+
+    def __init__(self):
+        self.routes = {}
+
+    def clear(self):
+        self.routes.clear()
+
+    def get(self, xml):
+        route = self.routes.get(xml)
+        if route is None:
+            route = self.routes[xml] = Route(xml)
+        return route
+
+
 class Scenario(object):
 
     basic_data = None
-    detailed_data = None
+    player_data = None
     route_xml = None
 
     debug_filenames = None
 
     def __init__(self, xml_basic, xml_detailed, xml_route):
-        self.basic_data = xmltodict.parse(open(xml_basic, encoding='utf-8').read())['cScenarioProperties']
-        self.detailed_data = xmltodict.parse(open(xml_detailed, encoding='utf-8').read())['cRecordSet']['Record']
+        import xmltodict
+
+        with profiler.phase('parse ScenarioProperties.xml') as parsed_bytes:
+            with content.open(xml_basic) as f:
+                data = f.read()
+            parsed_bytes[0] = len(data)
+            self.basic_data = xmltodict.parse(data)['cScenarioProperties']
+        # xml_detailed may be omitted when only the metadata from ScenarioProperties.xml is needed
+        if xml_detailed is not None:
+            xml_detailed = scenario_source(xml_detailed)
+            self.player_data = parse_player_consist(xml_detailed)
+            if self.player_data is None:
+                logging.error('Unable to fetch player service from %s' % xml_detailed)
         self.route_xml = xml_route
         self.debug_filenames = [xml_route, xml_basic, xml_detailed]
 
@@ -167,10 +1164,10 @@ class Scenario(object):
     @property
     def driver_instructions(self):
         if self.player_service is None:
-            return []
+            return Timetable([], self.start_datetime)
 
         all_instructions = self.player_service['Driver']['cDriver']['DriverInstructionContainer']['cDriverInstructionContainer']['DriverInstruction']
-        return_instructions = []
+        targets = []
         for instruction_type in all_instructions:
             if instruction_type in ['cTriggerInstruction']:
                 continue
@@ -186,13 +1183,9 @@ class Scenario(object):
                 instructions = instructions['DeltaTarget']['cDriverInstructionTarget']
                 if not isinstance(instructions, list):
                     instructions = [instructions]
+                targets.extend(instructions)
 
-                for instruction in instructions:
-                    instruction = DriverInstruction(instruction, self.start_datetime)
-                    if instruction.location and (instruction.arrival or instruction.departure):
-                        return_instructions.append(instruction)
-
-        return sorted(return_instructions, key=lambda i: i.departure)
+        return Timetable(targets, self.start_datetime)
 
     @property
     def duration(self):
@@ -204,12 +1197,12 @@ class Scenario(object):
     @property
     def formation(self):
         # for some reason this is usually flipped
-        initial_rv = self.player_service['Driver']['cDriver']['InitialRV']['e']
-        if not isinstance(initial_rv, list):
-            initial_rv = [initial_rv]
         try:
+            initial_rv = self.player_service['Driver']['cDriver']['InitialRV']['e']
+            if not isinstance(initial_rv, list):
+                initial_rv = [initial_rv]
             return [c['#text'] for c in initial_rv[::-1]]
-        except TypeError:
+        except (KeyError, TypeError):
             return []
 
     @property
@@ -221,24 +1214,30 @@ class Scenario(object):
 
     @property
     def player_service(self):
-        for consist in self.detailed_data['cConsist']:
-            try:
-                if consist['Driver']['cDriver']['PlayerDriver']['#text'] == '1':
-                    return consist
-            except (KeyError, TypeError):
-                pass
-        logging.error('Unable to fetch player service', json.dumps(self.detailed_data['cConsist'], indent=4))
+        return self.player_data
 
     @property
     def route(self):
-        return Route(self.route_xml)
+        return routes.get(self.route_xml)
 
     @property
     def service_name(self):
         try:
             return self.player_service['Driver']['cDriver']['ServiceName']['Localisation-cUserLocalisedString']['English']['#text']
         except (KeyError, TypeError):
-            return ''
+            pass
+
+        # without Scenario.xml fall back to the front end details stored in ScenarioProperties.xml
+        try:
+            drivers = self.basic_data['FrontEndDriverList']['sDriverFrontEndDetails']
+            if not isinstance(drivers, list):
+                drivers = [drivers]
+            for driver in drivers:
+                if driver['PlayerDriver']['#text'] == '1':
+                    return driver['ServiceName']['Localisation-cUserLocalisedString']['English']['#text']
+        except (KeyError, TypeError):
+            pass
+        return ''
 
     @property
     def scenario_class(self):
@@ -277,8 +1276,927 @@ class Scenario(object):
         try:
             vmax_kph = int(self.player_service['MaxPermissibleSpeed']['#text'])
             return round(vmax_kph / 1.609)
-        except (KeyError, ValueError):
+        except (KeyError, TypeError, ValueError):
+            return
+
+    def summary(self):
+        return ScenarioSummary(self)
+
+
+class ScenarioFilter(object):
+    """
+    Scenario selection criteria compiled to SQL conditions over the indexed metadata.
+
+    Each expression is a field, '=' and a value, all expressions have to match:
+
+    * ``route=GEML*,Portsmouth*`` route name globs, any of them
+    * ``class=timetable`` scenario class globs, a plain word matches anywhere in the class
+    * ``date=1980..1999`` start date range, each end can be a year, a month or a day
+    * ``duration=30..90``, ``vmax=..100`` and ``formation=4..`` ranges of whole numbers
+
+    Any end of a range can be left out, a single value means exactly that. vmax and formation
+    length are only in the index for scenarios loaded before, so scenarios not knowing them
+    yet pass the SQL conditions and are checked again with matches() once loaded.
+    """
+
+    FIELDS = ('class', 'date', 'duration', 'formation', 'route', 'vmax')
+
+    conditions = None
+    params = None
+    ranges = None
+
+    def __init__(self, expressions=()):
+        self.conditions = []
+        self.params = []
+        self.ranges = []
+        for expression in expressions:
+            self.add(expression)
+
+    def __bool__(self):
+        return bool(self.conditions)
+
+    def add(self, expression):
+        """
+        Add one expression, raise ValueError if it cannot be understood
+        """
+        field, separator, value = expression.partition('=')
+        field = field.strip().lower()
+        value = value.strip()
+        if not separator or field not in self.FIELDS or not value:
+            raise ValueError('Unable to understand filter "%s", expected one of %s followed by =value' % (
+                expression, ', '.join(self.FIELDS)))
+        getattr(self, '_add_' + field)(value)
+
+    def matches(self, summary):
+        """
+        Check ranges that cannot be told from the index before the scenario is loaded
+        """
+        for attribute, low, high in self.ranges:
+            value = summary.vmax if attribute == 'vmax' else len(summary.formation)
+            if value is None or (low is not None and value < low) or (high is not None and value > high):
+                return False
+        return True
+
+    def _add_class(self, value):
+        patterns = [pattern if glob.has_magic(pattern) else '*%s*' % pattern for pattern in value.lower().split(',')]
+        self._add_globs('lower(s.scenario_class)', patterns)
+
+    def _add_date(self, value):
+        low, high = self._range(value, str)
+        if low is not None:
+            self.conditions.append('s.start_datetime >= ?')
+            self.params.append(low)
+        if high is not None:
+            # ISO dates compare as text, 'Z' sorts after any date or time following the prefix
+            self.conditions.append('s.start_datetime <= ?')
+            self.params.append(high + 'Z')
+
+    def _add_duration(self, value):
+        self._add_range('s.duration', self._range(value, int))
+
+    def _add_formation(self, value):
+        low, high = self._range(value, int)
+        self._add_range('s.formation_length', (low, high), unknown=True)
+        self.ranges.append(('formation', low, high))
+
+    def _add_globs(self, column, patterns):
+        self.conditions.append('(%s)' % ' OR '.join(['%s GLOB ?' % column] * len(patterns)))
+        self.params.extend(patterns)
+
+    def _add_range(self, column, value_range, unknown=False):
+        conditions = []
+        for operator, value in zip(('>=', '<='), value_range):
+            if value is not None:
+                conditions.append('%s %s ?' % (column, operator))
+                self.params.append(value)
+        condition = ' AND '.join(conditions)
+        if unknown:
+            condition = '(%s IS NULL OR (%s))' % (column, condition)
+        self.conditions.append(condition)
+
+    def _add_route(self, value):
+        self._add_globs('lower(r.name)', value.lower().split(','))
+
+    def _add_vmax(self, value):
+        low, high = self._range(value, int)
+        self._add_range('s.vmax', (low, high), unknown=True)
+        self.ranges.append(('vmax', low, high))
+
+    @staticmethod
+    def _range(value, convert):
+        low, separator, high = value.partition('..')
+        if not separator:
+            high = low
+        low = convert(low.strip()) if low.strip() else None
+        high = convert(high.strip()) if high.strip() else None
+        if low is None and high is None:
+            raise ValueError('Range "%s" has no ends' % value)
+        return low, high
+
+
+class ScenarioIndex(object):
+    """
+    Persistent SQLite index of scenario metadata.
+
+    Each ScenarioProperties.xml and RouteProperties.xml is stored together with its
+    mtime and size, so only the files that changed since the last run are parsed again.
+    Scenarios also keep a hash of ScenarioProperties.xml: copies of a scenario shipped in
+    several places are recognised by devstring and hash, and indexed without parsing.
+    vmax and formation length come from Scenario.xml and are only filled in once a scenario
+    has been fully loaded.
+    """
+
+    connection = None
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS routes (
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            name TEXT,
+            uuids TEXT
+        );
+        CREATE TABLE IF NOT EXISTS scenarios (
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            route_path TEXT NOT NULL,
+            name TEXT,
+            devstring TEXT,
+            uuids TEXT,
+            scenario_class TEXT,
+            duration INTEGER,
+            start_datetime TEXT,
+            service_name TEXT,
+            content_hash TEXT,
+            vmax INTEGER,
+            formation_length INTEGER
+        );
+        CREATE TABLE IF NOT EXISTS cache (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL,
+            updated REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS folders (
+            path TEXT PRIMARY KEY,
+            signature TEXT NOT NULL,
+            listing TEXT NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS conversion_failures (
+            path TEXT PRIMARY KEY,
+            mtime INTEGER NOT NULL,
+            size INTEGER NOT NULL,
+            error TEXT
+        );
+    """
+
+    def __init__(self, path):
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.executescript(self.SCHEMA)
+
+        columns = set(row['name'] for row in self.connection.execute('PRAGMA table_info(scenarios)'))
+        if 'content_hash' not in columns:
+            # indexed before content hashes were kept, have all scenarios parsed again
+            self.connection.execute('ALTER TABLE scenarios ADD COLUMN content_hash TEXT')
+            self.connection.execute('UPDATE scenarios SET mtime = 0')
+        for column in ('vmax', 'formation_length'):
+            if column not in columns:
+                self.connection.execute('ALTER TABLE scenarios ADD COLUMN %s INTEGER' % column)
+        for column in ('content_hash',) + SCENARIO_INDEXED_COLUMNS:
+            self.connection.execute('CREATE INDEX IF NOT EXISTS scenarios_{0} ON scenarios ({0})'.format(column))
+        self.connection.execute('CREATE INDEX IF NOT EXISTS routes_name ON routes (name)')
+        self.connection.commit()
+
+    def cache(self, key, value):
+        self.connection.execute(
+            'INSERT OR REPLACE INTO cache (key, value, updated) VALUES (?, ?, ?)', (key, str(value), time.time()))
+        self.connection.commit()
+
+    def cached(self, key):
+        """
+        Return (value, timestamp) stored by cache() or None
+        """
+        row = self.connection.execute('SELECT value, updated FROM cache WHERE key = ?', (key,)).fetchone()
+        if row is not None:
+            return row['value'], row['updated']
+
+    def close(self):
+        self.connection.close()
+
+    def conversion_failures(self):
+        return dict(
+            (row['path'], (row['mtime'], row['size']))
+            for row in self.connection.execute('SELECT path, mtime, size FROM conversion_failures')
+        )
+
+    def record_conversion_failures(self, failures):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO conversion_failures (path, mtime, size, error) VALUES (?, ?, ?, ?)',
+            [(path,) + failure for path, failure in failures.items()]
+        )
+        self.connection.commit()
+
+    def folder_listings(self):
+        """
+        What ContentScanner found in each route folder: (signature, listing) by path
+        """
+        return dict(
+            (row['path'], (json.loads(row['signature']), json.loads(row['listing'])))
+            for row in self.connection.execute('SELECT path, signature, listing FROM folders')
+        )
+
+    def forget_folders(self, paths):
+        self.connection.executemany('DELETE FROM folders WHERE path = ?', [(path,) for path in paths])
+        self.connection.commit()
+
+    def iter_records(self, scenario_filter=None):
+        """
+        Stream ScenarioRecords matching scenario_filter straight from the database, grouped by route name
+        """
+        conditions = ['s.devstring IS NOT NULL']
+        params = []
+        if scenario_filter is not None:
+            conditions.extend(scenario_filter.conditions)
+            params.extend(scenario_filter.params)
+        rows = self.connection.execute("""
+            SELECT s.*, r.name AS route_name
+            FROM scenarios s LEFT JOIN routes r ON r.path = s.route_path
+            WHERE %s
+            ORDER BY r.name, s.path
+        """ % ' AND '.join(conditions), params)
+        for row in rows:
+            yield ScenarioRecord(row)
+
+    def record_details(self, details):
+        """
+        Store vmax and formation length learned by loading scenarios, see ScenarioLoader.details
+        """
+        self.connection.executemany(
+            'UPDATE scenarios SET vmax = ?, formation_length = ? WHERE path = ?',
+            [values + (path,) for path, values in details.items()]
+        )
+        self.connection.commit()
+
+    def record_folder_listings(self, listings):
+        self.connection.executemany(
+            'INSERT OR REPLACE INTO folders (path, signature, listing) VALUES (?, ?, ?)',
+            [(path, json.dumps(signature), json.dumps(listing)) for path, (signature, listing) in listings.items()]
+        )
+        self.connection.commit()
+
+    def records(self, scenario_filter=None):
+        return list(self.iter_records(scenario_filter))
+
+    def refresh(self, scenario_xmls, ignored_routes=(), stats=None):
+        """
+        Synchronise the index with the given list of ScenarioProperties.xml paths.
+
+        Routes are refreshed first, so that scenarios of missing or ignored routes
+        are never opened. stats may provide (mtime_ns, size) of files already known,
+        as collected by ContentScanner, the rest is looked up.
+        """
+        stats = stats or {}
+        route_xmls = set(route_xml_for(scenario_xml) for scenario_xml in scenario_xmls)
+        self._refresh_table('routes', route_xmls, self._parse_route, stats)
+
+        route_names = dict(
+            (row['path'], row['name']) for row in self.connection.execute('SELECT path, name FROM routes')
+        )
+        allowed_scenario_xmls = []
+        for scenario_xml in scenario_xmls:
+            route_name = route_names.get(route_xml_for(scenario_xml))
+            if route_name is None:
+                profiler.count('missing route')
+            elif route_name in ignored_routes:
+                profiler.count('ignored route')
+            else:
+                allowed_scenario_xmls.append(scenario_xml)
+        scenario_xmls = allowed_scenario_xmls
+        self._refresh_table('scenarios', scenario_xmls, self._parse_scenario, stats)
+        self.connection.commit()
+
+    def _parse_route(self, xml):
+        try:
+            route = routes.get(xml)
+            return {'name': route.name, 'uuids': json.dumps(route.uuids)}
+        except Exception:
+            logging.debug('Unable to index route %s' % xml, exc_info=True)
+            return {}
+
+    def _parse_scenario(self, xml):
+        values = {'route_path': route_xml_for(xml)}
+        try:
+            with content.open(xml) as f:
+                values['content_hash'] = hashlib.sha1(f.read()).hexdigest()
+            copy = self.connection.execute(
+                'SELECT * FROM scenarios WHERE content_hash = ? AND devstring IS NOT NULL AND path != ? LIMIT 1',
+                (values['content_hash'], xml)
+            ).fetchone()
+            if copy is not None:
+                profiler.tally('identical copy indexed')
+                for column in SCENARIO_COPY_COLUMNS:
+                    values[column] = copy[column]
+                return values
+
+            scenario = Scenario(xml, None, values['route_path'])
+            start_datetime = scenario.start_datetime
+            values.update({
+                'name': scenario.name,
+                'devstring': scenario.devstring,
+                'uuids': json.dumps(scenario.uuids),
+                'scenario_class': scenario.scenario_class,
+                'duration': scenario.duration,
+                'start_datetime': start_datetime.isoformat() if start_datetime else None,
+                'service_name': scenario.service_name,
+            })
+        except Exception:
+            logging.debug('Unable to index scenario %s' % xml, exc_info=True)
+        return values
+
+    def _refresh_table(self, table, paths, parse, stats):
+        known = dict(
+            (row['path'], (row['mtime'], row['size']))
+            for row in self.connection.execute('SELECT path, mtime, size FROM %s' % table)
+        )
+        for path in paths:
+            stat = stats.get(path) or content.stat(path)
+            if stat is None:
+                continue
+            known_stat = known.pop(path, None)
+            if known_stat == stat:
+                continue
+            values = parse(path)
+            values.update({'path': path, 'mtime': stat[0], 'size': stat[1]})
+            self.connection.execute(
+                'INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (
+                    table, ', '.join(values), ', '.join('?' * len(values))),
+                list(values.values())
+            )
+
+        # whatever is left was either deleted or is not there anymore
+        self.connection.executemany('DELETE FROM %s WHERE path = ?' % table, [(path,) for path in known])
+
+
+class ScenarioLoader(object):
+    """
+    Fully loads scenarios for a sequence of ScenarioRecords.
+
+    With more than one job, records further down the sequence are speculatively parsed
+    in a process pool while the current one is being consumed. Records are still handed
+    out strictly in the original order, so the outcome does not depend on which worker
+    finishes first. Given a Converter, missing Scenario.xml files of upcoming records
+    are unpacked ahead as well. Identical copies of a scenario already loaded are not
+    parsed again, the summary of the first copy is handed out instead.
+
+    vmax and formation length of every loaded scenario are collected in details, so that
+    they can be stored in ScenarioIndex.
+    """
+
+    converter = None
+    current = None
+    details = None
+    executor = None
+    pending = None
+    records = None
+    summaries = None
+
+    def __init__(self, records, jobs=1, converter=None, summaries=None):
+        self.records = iter(records)
+        self.converter = converter
+        self.pending = collections.deque()
+        # may be shared by several loaders, to hand out scenarios loaded before as copies
+        self.summaries = summaries if summaries is not None else {}
+        self.details = {}
+        if jobs > 1:
+            self.executor = get_process_pool(jobs)
+        workers = max(jobs, converter.jobs if converter is not None else 1)
+        self.lookahead = workers * 2 if workers > 1 else 1
+
+    def __iter__(self):
+        while True:
+            self._discard_current()
+            self._fill()
+            if not self.pending:
+                return
+            self.current = self.pending.popleft()
+            yield self.current[0]
+
+    def close(self):
+        """
+        Cancel all speculative work that has not been consumed yet
+        """
+        self._discard_current()
+        while self.pending:
+            self._cancel(self.pending.popleft())
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+
+    def load(self, record):
+        """
+        Return the loaded Scenario for the record most recently handed out by the iterator
+        """
+        assert self.current is not None and self.current[0] is record
+        record, conversion, parsing = self.current
+        self.current = None
+        identity = record.identity
+        if identity in self.summaries:
+            profiler.tally('identical copy reused')
+            summary = self.summaries[identity]
+        else:
+            if conversion is not None and not conversion.result():
+                # the reason is counted by Converter.convert
+                profiler.count('conversion failure')
+                return
+            if parsing is None:
+                summary = parse_scenario(record)
+            else:
+                summary, snapshot = parsing.result()
+                profiler.merge(snapshot)
+            if summary is None and self.converter is not None and self.converter.fallback(record.xml_detailed):
+                summary = parse_scenario(record)
+            if summary is None:
+                profiler.count('parse failure')
+                return
+            if identity is not None:
+                self.summaries[identity] = summary
+        self.details[record.path] = (summary.vmax, len(summary.formation))
+        return summary
+
+    def _cancel(self, entry):
+        for future in entry[1:]:
+            if future is not None:
+                future.cancel()
+
+    def _discard_current(self):
+        if self.current is not None:
+            self._cancel(self.current)
+        self.current = None
+
+    def _fill(self):
+        while len(self.pending) < self.lookahead:
+            try:
+                record = next(self.records)
+            except StopIteration:
+                break
+            if self._is_copy(record):
+                # the first copy is loaded in its place
+                self.pending.append([record, None, None])
+                continue
+            conversion = None
+            if self.converter is not None:
+                conversion = self.converter.submit(record.xml_detailed)
+            self.pending.append([record, conversion, None])
+
+        # parsing is only started for records that do not wait for the converter anymore
+        if self.executor is not None:
+            identities = set(self.summaries)
+            for entry in self.pending:
+                record, conversion, parsing = entry
+                if record.identity is not None:
+                    if record.identity in identities:
+                        continue
+                    identities.add(record.identity)
+                if parsing is None and (conversion is None or (conversion.done() and conversion.result())):
+                    entry[2] = self.executor.submit(parse_scenario_job, record)
+
+    def _is_copy(self, record):
+        identity = record.identity
+        if identity is None:
+            return False
+        return identity in self.summaries or any(entry[0].identity == identity for entry in self.pending)
+
+
+class ScenarioRecord(object):
+    """
+    Scenario metadata as stored in ScenarioIndex
+    """
+
+    def __init__(self, row):
+        self.path = row['path']
+        self.route_path = row['route_path']
+        self.route_name = row['route_name']
+        self.name = row['name']
+        self.devstring = row['devstring']
+        self.uuids = json.loads(row['uuids'])
+        self.scenario_class = row['scenario_class']
+        self.duration = row['duration'] or 0
+        # cheaper than strptime, which imports its locale machinery on first use
+        self.start_datetime = (datetime.datetime(*map(int, re.split('[-T:]', row['start_datetime'])))
+                               if row['start_datetime'] else None)
+        self.service_name = row['service_name']
+        self.content_hash = row['content_hash']
+        self.vmax = row['vmax']
+        self.formation_length = row['formation_length']
+
+    def __str__(self):
+        return '{}: {}'.format(self.devstring, self.name)
+
+    @property
+    def identity(self):
+        """
+        Same for all identical copies of a scenario, None if that cannot be told
+        """
+        if self.content_hash is not None:
+            return self.devstring, self.content_hash
+
+    @property
+    def xml_detailed(self):
+        return self.path.replace('ScenarioProperties.xml', 'Scenario.xml')
+
+
+class ScenarioSampler(object):
+    """
+    Weighted random order of ScenarioRecords, drawn without replacement.
+
+    Every record gets the Efraimidis-Spirakis key u ** (1 / weight) for a uniform random u;
+    records sorted by descending key are a weighted sample of any size. Keys are computed in
+    a single pass over the metadata from the index and kept in a heap, so drawing k records
+    costs O(n + k log n) and only the drawn ones ever need to be parsed.
+    """
+
+    heap = None
+
+    def __init__(self, records, weight=None, rng=random):
+        self.heap = []
+        for i, record in enumerate(records):
+            record_weight = weight(record) if weight is not None else 1
+            if record_weight <= 0:
+                profiler.count('zero weight')
+                continue
+            # log(u) / weight orders records the same way as u ** (1 / weight) without underflow
+            key = math.log(1.0 - rng.random()) / record_weight
+            self.heap.append((-key, i, record))
+        heapq.heapify(self.heap)
+
+    def __iter__(self):
+        while self.heap:
+            yield heapq.heappop(self.heap)[2]
+
+    def __len__(self):
+        return len(self.heap)
+
+
+class ScenarioSummary(object):
+    """
+    Everything a work order needs to know about a scenario.
+
+    Filled once from a fully parsed Scenario, after which the xmltodict trees
+    can be released. The template reads plain attributes instead of recomputing
+    Scenario properties on every access.
+    """
+
+    __slots__ = (
+        'briefing', 'debug_filenames', 'description', 'devstring', 'driver_instructions', 'duration',
+        'formation', 'name', 'route_xml', 'scenario_class', 'service_name', 'start_datetime',
+        'start_location', 'uuids', 'vmax',
+    )
+
+    def __init__(self, scenario):
+        self.briefing = scenario.briefing
+        self.debug_filenames = scenario.debug_filenames
+        self.description = scenario.description
+        self.devstring = scenario.devstring
+        self.driver_instructions = scenario.driver_instructions
+        self.duration = scenario.duration
+        self.formation = scenario.formation
+        self.name = scenario.name
+        self.route_xml = scenario.route_xml
+        self.scenario_class = scenario.scenario_class
+        self.service_name = scenario.service_name
+        self.start_datetime = scenario.start_datetime
+        self.start_location = scenario.start_location
+        self.uuids = scenario.uuids
+        self.vmax = scenario.vmax
+
+    def __str__(self):
+        return '{}: {}'.format(self.devstring, self.name)
+
+    @property
+    def route(self):
+        return routes.get(self.route_xml)
+
+
+class SerzReader(object):
+    """
+    Reads the Serz binary format of Scenario.bin, without unpacking it to Scenario.xml first.
+
+    After SERZ_MAGIC and a version, the file is a sequence of records. A record starts
+    either with 0xFF, its kind and its definition (element name and, for values, their
+    type) or with the slot of an earlier definition, the last SERZ_DEFINITION_SLOTS of
+    which are remembered. The data of the record follows. Strings are stored the first
+    time they occur and later referred to by their position.
+
+    Records are handed out as the events an XML parser would see in Scenario.xml, with
+    values formatted the way Serz.exe writes them.
+    """
+
+    ARRAY = ord('A')
+    CLOSE = ord('p')
+    EMPTY = ord('N')
+    OPEN = ord('P')
+    REFERENCE = ord('R')
+    VALUE = ord('V')
+
+    data = None
+    offset = None
+    strings = None
+
+    def __init__(self, data):
+        if data[:len(SERZ_MAGIC)] != SERZ_MAGIC:
+            raise ValueError('Not a Serz file')
+        self.data = data
+        self.offset = len(SERZ_MAGIC) + 4
+        self.strings = []
+
+    def __iter__(self):
+        """
+        Yield ('open', name, attributes), ('value', name, attributes, text) and ('close', name) events
+        """
+        data = self.data
+        definitions = [None] * SERZ_DEFINITION_SLOTS
+        next_slot = 0
+        while self.offset < len(data):
+            marker = data[self.offset]
+            self.offset += 1
+            if marker == 0xFF:
+                kind = data[self.offset]
+                self.offset += 1
+                definition = (kind, self._string(), self._string() if kind in (self.ARRAY, self.VALUE) else None)
+                definitions[next_slot] = definition
+                next_slot = (next_slot + 1) % SERZ_DEFINITION_SLOTS
+            else:
+                definition = definitions[marker]
+                if definition is None:
+                    raise ValueError('Record refers to undefined slot %d at %d' % (marker, self.offset - 1))
+            kind, name, value_type = definition
+
+            if kind == self.OPEN:
+                element_id = self._unpack('II')[0]
+                yield ('open', name, {'d:id': str(element_id)} if element_id else {})
+            elif kind == self.CLOSE:
+                yield ('close', name)
+            elif kind == self.VALUE:
+                attributes = {'d:type': value_type}
+                if value_type in SERZ_FLOAT_TYPES:
+                    attributes['d:precision'] = 'string'
+                yield ('value', name, attributes, self._value(value_type))
+            elif kind == self.ARRAY:
+                count = data[self.offset]
+                self.offset += 1
+                attributes = {'d:numElements': str(count), 'd:elementType': value_type}
+                if value_type in SERZ_FLOAT_TYPES:
+                    attributes['d:precision'] = 'string'
+                yield ('value', name, attributes, ' '.join(self._value(value_type) for _ in range(count)))
+            elif kind == self.REFERENCE:
+                yield ('value', name, {'d:type': 'ref'}, str(self._unpack('I')[0]))
+            elif kind == self.EMPTY:
+                yield ('value', name, {}, None)
+            else:
+                raise ValueError('Unknown record kind %r at %d' % (chr(kind), self.offset))
+
+    def _string(self):
+        position = self._unpack('H')[0]
+        if position != 0xFFFF:
+            return self.strings[position]
+        length = self._unpack('I')[0]
+        string = self.data[self.offset:self.offset + length].decode('utf-8')
+        self.offset += length
+        self.strings.append(string)
+        return string
+
+    def _unpack(self, value_format):
+        values = struct.unpack_from('<' + value_format, self.data, self.offset)
+        self.offset += struct.calcsize('<' + value_format)
+        return values
+
+    def _value(self, value_type):
+        if value_type == 'cDeltaString':
+            return self._string()
+        value = self._unpack(SERZ_VALUE_FORMATS[value_type])[0]
+        if value_type not in SERZ_FLOAT_TYPES:
+            return str(value)
+        # the shortest text that reads back as the same number
+        float_format = '<' + SERZ_FLOAT_TYPES[value_type]
+        for digits in range(6, 18):
+            text = '%.*g' % (digits, value)
+            if struct.unpack(float_format, struct.pack(float_format, float(text)))[0] == value:
+                return text
+        return repr(value)
+
+
+class SteamLookup(object):
+    """
+    Fetches minutes played in the last two weeks from the Steam Web API in a background
+    thread, so that it overlaps with scanning the scenarios.
+
+    The steam ID resolved from a profile name is cached for good and the playtime for
+    STEAM_PLAYTIME_TTL seconds, both in the scenario index. A fresh cached playtime is used
+    without asking Steam at all. If Steam does not answer within the timeout, counted from
+    start(), the cached playtime is used no matter how old it is.
+    """
+
+    api_key = None
+    api_url = None
+    cached_minutes = None
+    cached_steam_id = None
+    deadline = None
+    error = None
+    index = None
+    profile = None
+    result = None
+    thread = None
+    timeout = None
+
+    def __init__(self, profile, index, api_key=STEAM_API_KEY, api_url=STEAM_API_URL, timeout=STEAM_TIMEOUT):
+        self.profile = str(profile)
+        self.index = index
+        self.api_key = api_key
+        self.api_url = api_url
+        self.timeout = timeout
+
+        if self.profile.isnumeric():
+            self.cached_steam_id = self.profile
+        else:
+            cached = index.cached('steam id %s' % self.profile)
+            self.cached_steam_id = cached and cached[0]
+        cached = self.cached_steam_id and index.cached('steam minutes played %s' % self.cached_steam_id)
+        if cached:
+            self.cached_minutes = (int(cached[0]), cached[1])
+
+    def minutes_played(self):
+        """
+        Wait for the lookup until the deadline, then return minutes played or None if unknown
+        """
+        if self.thread is not None:
+            self.thread.join(max(self.deadline - time.time(), 0))
+
+        if self.result is not None:
+            steam_id, minutes = self.result
+            if steam_id != self.profile:
+                self.index.cache('steam id %s' % self.profile, steam_id)
+            self.index.cache('steam minutes played %s' % steam_id, minutes)
+            return minutes
+
+        if self.thread is not None:
+            logging.warning('Steam did not answer in time (%s), falling back to cached playtime' % (
+                self.error or 'timeout'))
+        if self.cached_minutes is not None:
+            return self.cached_minutes[0]
+
+    def start(self):
+        if self.cached_minutes is not None and self.cached_minutes[1] > time.time() - STEAM_PLAYTIME_TTL:
+            return
+        self.deadline = time.time() + self.timeout
+        self.thread = threading.Thread(target=self._lookup)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def _lookup(self):
+        try:
+            steam_id = self.cached_steam_id
+            if steam_id is None:
+                steam_id = get_steam_profile_id(self.profile, self.api_key, self.api_url, self._remaining())
+            minutes = get_steam_minutes_played(steam_id, self.api_key, self.api_url, self._remaining())
+            self.result = (steam_id, minutes)
+        except Exception as exc:
+            self.error = exc
+
+    def _remaining(self):
+        return max(self.deadline - time.time(), 0.001)
+
+
+class Timetable(object):
+    """
+    Driver instructions of the player service stored column by column.
+
+    Instruction targets are read once into parallel arrays of due times, durations and
+    stopping flags plus lists of interned locations and extras, ordered by due time.
+    The summary of a scenario stays small and quick to pickle; DriverInstruction rows
+    with actual datetimes are only created when the timetable is iterated for rendering.
+    """
+
+    __slots__ = ('due_times', 'durations', 'extras', 'locations', 'start_datetime', 'stopping')
+
+    def __init__(self, targets, start_datetime):
+        self.start_datetime = start_datetime
+        rows = []
+        if start_datetime:
+            for target in targets:
+                location = self._location(target)
+                due_time = float(target['DueTime']['#text'])
+                if not location or not due_time:
+                    continue
+                rows.append((
+                    due_time, int(float(target['Duration']['#text'])), self._stopping(target),
+                    sys.intern(location), self._extra(target)
+                ))
+        rows.sort(key=lambda row: row[0])
+
+        self.due_times = array.array('d', [row[0] for row in rows])
+        self.durations = array.array('l', [row[1] for row in rows])
+        self.stopping = array.array('b', [row[2] for row in rows])
+        self.locations = [row[3] for row in rows]
+        self.extras = [row[4] for row in rows]
+
+    def __iter__(self):
+        return iter(self.rows())
+
+    def __len__(self):
+        return len(self.due_times)
+
+    def rows(self):
+        """
+        Materialize DriverInstructions, computing all arrival and departure times in one go
+        """
+        start = self.start_datetime
+        timedelta = datetime.timedelta
+        return [
+            DriverInstruction(
+                location, extra,
+                start + timedelta(seconds=due_time - duration) if duration else None,
+                start + timedelta(seconds=due_time),
+                bool(stopping)
+            )
+            for due_time, duration, stopping, location, extra in zip(
+                self.due_times, self.durations, self.stopping, self.locations, self.extras)
+        ]
+
+    @classmethod
+    def _extra(cls, data):
+        try:
+            operation = data['Operation']['#text'].lower()
+        except (KeyError, TypeError):
             return
+        operation_handler = getattr(cls, '_operation_' + operation, None)
+        if operation_handler is not None:
+            return operation_handler(data)
+
+    @staticmethod
+    def _location(data):
+        try:
+            return data['DisplayName']['#text']
+        except TypeError:
+            logging.debug('Unable to fetch driver instruction location')
+            logging.debug(json.dumps(data, indent=4))
+            return ''
+
+    @staticmethod
+    def _operation_addtoback(data):
+        cars = data['RailVehicleNumber']['e']
+        if not isinstance(cars, list):
+            cars = [cars]
+        return 'Attach {0}'.format(', '.join([c['#text'] for c in cars]))
+
+    @staticmethod
+    def _operation_dropoffrailvehicle(data):
+        cars = data['RailVehicleNumber']['e']
+        if not isinstance(cars, list):
+            cars = [cars]
+        return 'Detach {0}'.format(', '.join([c['#text'] for c in cars]))
+
+    @staticmethod
+    def _stopping(data):
+        try:
+            return (
+                data['PickingUp']['#text'] == '1' and
+                data['Waypoint']['#text'] == '0') \
+                and data['MinSpeed']['#text'] == '0'
+        except KeyError:
+            return False
+
+
+content = ContentSource()
+profiler = Profiler()
+routes = RouteRegistry()
+
+
+def catalog_row(record, summary=None):
+    """
+    Catalog entry of a ScenarioRecord, formation length is only known once the scenario is parsed
+    """
+    return collections.OrderedDict([
+        ('route', record.route_name),
+        ('devstring', record.devstring),
+        ('name', record.name),
+        ('scenario_class', record.scenario_class),
+        ('duration', record.duration),
+        ('start_datetime', record.start_datetime.isoformat() if record.start_datetime else None),
+        ('service_name', record.service_name),
+        ('formation_length', len(summary.formation) if summary is not None else None),
+    ])
+
+
+def catalog_rows(loader, scenario_filter=None):
+    """
+    Yield catalog entries of records handed out by a ScenarioLoader one by one
+    """
+    for record in loader:
+        summary = loader.load(record)
+        if summary is not None and scenario_filter is not None and not scenario_filter.matches(summary):
+            profiler.count('filtered once loaded')
+            continue
+        yield catalog_row(record, summary)
 
 
 def dictget(dikt, key):
@@ -331,8 +2249,167 @@ def get_last_number(work_orders_folder):
     return last_number
 
 
-def get_steam_minutes_played(profile_id):
-    steam_response = steam.api.interface('IPlayerService').GetRecentlyPlayedGames(steamid=profile_id)
+def get_candidate_check(ignored_scenarios=(), recently_driven=(), exclude_recent=False):
+    """
+    Return a function telling whether a ScenarioRecord may be used in a work order.
+
+    Identical copies of a scenario make a single candidate, so one check should be used
+    per work order.
+    """
+    identities = set()
+
+    def is_candidate(record):
+        if record.scenario_class in IGNORED_SCENARIO_CLASSES:
+            profiler.count('ignored class')
+            return False
+
+        if record.devstring in ignored_scenarios:
+            logging.debug('Skipping scenario {} because scenario ignored'.format(record))
+            profiler.count('ignored devstring')
+            return False
+
+        if not record.name:
+            profiler.count('no name')
+            return False
+
+        if exclude_recent and record.devstring in recently_driven:
+            profiler.count('recently driven')
+            return False
+
+        if record.identity is not None:
+            if record.identity in identities:
+                profiler.count('identical copy')
+                return False
+            identities.add(record.identity)
+
+        return True
+
+    return is_candidate
+
+
+def get_converter(railworks_folder, config, index):
+    converter_config = config.get('converter') or {}
+    command = converter_config.get('command', CONVERTER_COMMAND)
+    native = converter_config.get('native')
+    if native is None:
+        # SerzReader is not checked against files written by Serz.exe, it only stands in for a missing converter
+        native = not is_command_available(railworks_folder, command)
+    return Converter(
+        railworks_folder,
+        command=command,
+        timeout=converter_config.get('timeout', CONVERTER_TIMEOUT),
+        jobs=converter_config.get('jobs', 1),
+        failures=index.conversion_failures(),
+        native=native
+    )
+
+
+def get_fragment_key(order, template_source, logo=None):
+    """
+    Hash of order.html, the logo and the signatures of the route and scenario files an order was loaded from
+    """
+    digest = hashlib.sha1(template_source.encode('utf-8'))
+    digest.update(json.dumps(logo).encode('utf-8'))
+    for path in order.debug_filenames:
+        digest.update(json.dumps([path, content.stat(path)]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+def get_logo_class(logo):
+    """
+    CSS class showing the logo file, as defined once per work order by disposition.html
+    """
+    if logo is None:
+        return
+    return 'logo-' + re.sub(r'[^A-Za-z0-9_-]', '_', logo)
+
+
+def get_process_pool(workers):
+    """
+    ProcessPoolExecutor starting its workers as fresh interpreters.
+
+    Forked workers would inherit the pipes of converter subprocesses being started in
+    other threads at the same time, and subprocess waits for those pipes to close.
+    """
+    import concurrent.futures
+    import multiprocessing
+
+    return concurrent.futures.ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context('spawn'))
+
+
+def get_recently_driven(config, ledger):
+    """
+    Devstrings of scenarios driven recently according to dispatcher.yaml and whether to exclude them
+    """
+    recently_driven_config = config.get('recently_driven') or {}
+    mode = recently_driven_config.get('mode', 'avoid')
+    if mode not in RECENTLY_DRIVEN_MODES:
+        raise DispatcherError(
+            'recently_driven.mode in dispatcher.yaml should be one of: %s' % ', '.join(RECENTLY_DRIVEN_MODES))
+    recently_driven = set()
+    if recently_driven_config.get('days'):
+        recently_driven = ledger.driven_since(time.time() - recently_driven_config['days'] * 24 * 60 * 60)
+    return recently_driven, mode == 'exclude'
+
+
+def get_sampling_weight(config, records, last_driven, now=None):
+    """
+    Weight function for ScenarioSampler built from the sampling section of dispatcher.yaml.
+
+    Scenarios not driven for a long time, from routes with few scenarios, set in the preferred
+    era or lasting the preferred time are more likely to be drawn.
+    """
+    now = now or time.time()
+    recency = config.get('recency', 1)
+    route_balance = config.get('route_balance', 0.5)
+    era = config.get('era')
+    era_weight = config.get('era_weight', 4)
+    duration = config.get('duration')
+    duration_weight = config.get('duration_weight', 2)
+
+    route_sizes = collections.Counter(record.route_path for record in records)
+
+    def weight(record):
+        value = 1.0
+        if recency:
+            # a year without driving counts the same as never driven
+            days = min((now - last_driven.get(record.devstring, 0)) / (24 * 60 * 60), 365)
+            value *= ((days + 1) / 366) ** recency
+        if route_balance:
+            value *= route_sizes[record.route_path] ** -route_balance
+        if era and record.start_datetime and era[0] <= record.start_datetime.year <= era[1]:
+            value *= era_weight
+        if duration and duration[0] <= record.duration <= duration[1]:
+            value *= duration_weight
+        return value
+
+    return weight
+
+
+def get_scenario_filter(config, expressions=()):
+    try:
+        return ScenarioFilter((config.get('filters') or []) + list(expressions))
+    except ValueError as exc:
+        raise DispatcherError(str(exc))
+
+
+def get_steam_lookup(steam_config, index):
+    """
+    SteamLookup for the steam section of dispatcher.yaml, None if it names no profile
+    """
+    if not steam_config or not steam_config.get('profile'):
+        return
+    return SteamLookup(
+        steam_config['profile'], index,
+        api_key=steam_config.get('api_key') or STEAM_API_KEY,
+        api_url=steam_config.get('api_url') or STEAM_API_URL,
+        timeout=steam_config.get('timeout') or STEAM_TIMEOUT
+    )
+
+
+def get_steam_minutes_played(profile_id, api_key=STEAM_API_KEY, api_url=STEAM_API_URL, timeout=STEAM_TIMEOUT):
+    steam_response = steam_api(api_url, 'IPlayerService', 'GetRecentlyPlayedGames', api_key, timeout,
+                               steamid=profile_id)
     if not dictget(steam_response, 'response.total_count'):
         return 0
     for game in dictget(steam_response, 'response.games'):
@@ -341,11 +2418,28 @@ def get_steam_minutes_played(profile_id):
     return 0
 
 
-def get_steam_profile_id(nickname):
-    steam_response = steam.api.interface('ISteamUser').ResolveVanityURL(vanityurl='centralniak')
+def get_steam_profile_id(nickname, api_key=STEAM_API_KEY, api_url=STEAM_API_URL, timeout=STEAM_TIMEOUT):
+    steam_response = steam_api(api_url, 'ISteamUser', 'ResolveVanityURL', api_key, timeout, vanityurl=nickname)
     return dictget(steam_response, 'response.steamid')
 
 
+@functools.lru_cache()
+def get_template_environment(data_folder, cache_folder=None):
+    """
+    Shared Jinja environment; with cache_folder compiled templates are kept on disk between runs
+    """
+    import jinja2
+
+    bytecode_cache = None
+    if cache_folder is not None:
+        ensure_folder(cache_folder)
+        bytecode_cache = jinja2.FileSystemBytecodeCache(cache_folder)
+    return jinja2.Environment(
+        loader=jinja2.FileSystemLoader(os.path.join(data_folder, 'Templates')),
+        bytecode_cache=bytecode_cache
+    )
+
+
 def int_to_time(int_time):
     HOUR = 3600
     hours = int(int_time / HOUR)
@@ -353,6 +2447,33 @@ def int_to_time(int_time):
     return hours, minutes
 
 
+def is_command_available(railworks_folder, command):
+    """
+    Whether the program a converter command starts can be found, relative to the Railworks folder or on PATH
+    """
+    import shlex
+    import shutil
+
+    try:
+        program = shlex.split(command, posix=os.name != 'nt')[0].strip('"')
+    except (IndexError, ValueError):
+        return False
+    if os.path.isfile(os.path.join(railworks_folder, program)):
+        return True
+    return shutil.which(program) is not None
+
+
+def is_serz(path):
+    """
+    Whether path is a file in the Serz binary format
+    """
+    try:
+        with content.open(path) as f:
+            return f.read(len(SERZ_MAGIC)) == SERZ_MAGIC
+    except (IOError, KeyError):
+        return False
+
+
 def launch_html(path):
     try:
         os.startfile(path)
@@ -360,15 +2481,423 @@ def launch_html(path):
         os.system('xdg-open \'%s\'' % path)
 
 
+def load_artwork(path, index):
+    """
+    ArtworkIndex of artwork.yaml, kept in the index like the config until the file changes
+    """
+    stat = os.stat(path)
+    signature = [stat.st_mtime_ns, stat.st_size]
+    cached = index.cached('artwork')
+    if cached is not None:
+        cached = json.loads(cached[0])
+        if cached['signature'] == signature:
+            return ArtworkIndex(cached['periods'])
+
+    import yaml
+
+    with open(path) as f:
+        artwork = ArtworkIndex.from_config(yaml.safe_load(f))
+    index.cache('artwork', json.dumps({'signature': signature, 'periods': artwork.periods}))
+    return artwork
+
+
+def load_config(path, index):
+    """
+    Load dispatcher.yaml, a JSON copy kept in the index spares importing PyYAML until the file changes
+    """
+    stat = os.stat(path)
+    signature = [stat.st_mtime_ns, stat.st_size]
+    cached = index.cached('config')
+    if cached is not None:
+        cached = json.loads(cached[0])
+        if cached['signature'] == signature:
+            return cached['config']
+
+    import yaml
+
+    with open(path) as f:
+        config = yaml.safe_load(f)
+    try:
+        index.cache('config', json.dumps({'signature': signature, 'config': config}))
+    except TypeError:
+        logging.debug('Unable to cache config, it is parsed on every run', exc_info=True)
+    return config
+
+
 # @TODO: put this in a class
 def parse_args(args=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('work_orders', nargs='?')
+    parser.add_argument('--batch', action='store_true',
+                        help='make a work order for every driver listed under profiles in dispatcher.yaml')
+    parser.add_argument('--catalog', metavar='PATH',
+                        help='write every indexed scenario to this file, as CSV if it ends with .csv, '
+                             'as JSON lines otherwise, and exit')
     parser.add_argument('--debug', action='store_true')
+    parser.add_argument('--filter', action='append', default=[], metavar='EXPRESSION',
+                        help='only use scenarios matching this, e.g. route=GEML* or date=1980..1999; '
+                             'can be given more than once')
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address `serve` listens on')
+    parser.add_argument('--jobs', type=int, default=1,
+                        help='number of processes used to parse scenarios ahead of selection')
     parser.add_argument('--list', action='store_true')
+    parser.add_argument('--port', type=int, default=SERVE_PORT,
+                        help='port `serve` listens on')
+    parser.add_argument('--preconvert', action='store_true',
+                        help='unpack every Scenario.bin that has no Scenario.xml yet and exit')
+    parser.add_argument('--profile', action='store_true',
+                        help='print where the time went once done')
+    parser.add_argument('--profile-output',
+                        help='also write the profile to this file, as JSON if it ends with .json, '
+                             'as a cProfile dump otherwise')
+    parser.add_argument('--rescan', action='store_true',
+                        help='walk all route folders, also those that did not change since the last run')
+    parser.add_argument('--seed', type=int,
+                        help='draw the same scenarios again when given the same seed and library')
     return parser.parse_args(args)
 
 
+def parse_player_consist(xml):
+    """
+    Stream Scenario.xml, or Scenario.bin in the Serz format, and return only the cConsist
+    driven by the player.
+
+    Every other consist is discarded as soon as it has been read and parsing stops
+    right after the player consist is complete, so the cost depends on the player
+    service rather than on the number of AI services in the scenario.
+    """
+    player_consist = []
+
+    def handle_record_item(path, item):
+        if path[-1][0] != 'cConsist':
+            return True
+        try:
+            if item['Driver']['cDriver']['PlayerDriver']['#text'] == '1':
+                player_consist.append(item)
+                return False
+        except (KeyError, TypeError):
+            pass
+        return True
+
+    if xml.endswith('.bin'):
+        with profiler.phase('parse Scenario.bin') as parsed_bytes, content.open(xml) as f:
+            data = f.read()
+            parsed_bytes[0] = len(data)
+        profiler.tally('read natively')
+        try:
+            parse_serz_items(SerzReader(data), 3, handle_record_item)
+        except (ValueError, struct.error, KeyError, IndexError) as exc:
+            # ScenarioLoader falls back to the converter
+            logging.warning('Unable to read %s natively: %s' % (xml, exc))
+            profiler.tally('native read failure')
+            raise
+        return player_consist[0] if player_consist else None
+
+    import xmltodict
+
+    with profiler.phase('parse Scenario.xml') as parsed_bytes, content.open(xml) as f:
+        try:
+            # items at depth 3 are cRecordSet > Record > cConsist, since xmltodict 1.0.0 they
+            # are not attached to Record as well, so discarded consists do not pile up
+            xmltodict.parse(f, item_depth=3, item_callback=handle_record_item)
+        except xmltodict.ParsingInterrupted:
+            pass
+        parsed_bytes[0] = f.tell()
+
+    if player_consist:
+        return player_consist[0]
+
+
+def parse_serz_items(events, item_depth, item_callback):
+    """
+    Build elements from SerzReader events the way xmltodict.parse does with item_depth and
+    item_callback: elements at item_depth are handed to item_callback along with their path,
+    and reading stops once it returns False
+    """
+    path = []
+    stack = []
+
+    def close(name, attributes, children, text):
+        if attributes or children:
+            item = dict(('@' + key, value) for key, value in attributes.items())
+            item.update(children)
+            if text:
+                item['#text'] = text
+        else:
+            item = text or None
+        if len(path) == item_depth:
+            return item_callback(path, item)
+        parent = stack[-1][2]
+        if name not in parent:
+            parent[name] = item
+        elif isinstance(parent[name], list):
+            parent[name].append(item)
+        else:
+            parent[name] = [parent[name], item]
+        return True
+
+    for event in events:
+        if event[0] == 'open':
+            path.append(event[1:])
+            if len(path) >= item_depth:
+                stack.append((event[1], event[2], {}))
+        elif event[0] == 'value':
+            path.append(event[1:3])
+            if len(path) >= item_depth and not close(event[1], event[2], {}, event[3]):
+                return
+            path.pop()
+        else:
+            if len(path) >= item_depth:
+                name, attributes, children = stack.pop()
+                if not close(name, attributes, children, None):
+                    return
+            path.pop()
+
+
+def parse_scenario(record):
+    """
+    Fully parse the scenario described by given ScenarioRecord and return its ScenarioSummary,
+    or None if not possible
+    """
+    try:
+        return Scenario(record.path, record.xml_detailed, record.route_path).summary()
+    except Exception:
+        logging.debug('Unable to load scenario %s' % record, exc_info=True)
+
+
+def parse_scenario_job(record):
+    """
+    parse_scenario as run in a worker process, returns the profile of the job along with the summary
+    """
+    profiler.reset()
+    summary = parse_scenario(record)
+    return summary, profiler.snapshot()
+
+
+def parse_work_orders(value):
+    """
+    Number of work orders or (low, high) span of minutes they should take, from e.g. '2', '30m' or '2h'
+    """
+    try:
+        order_minutes = to_minutes(value)
+    except (TypeError, ValueError):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            raise DispatcherError('Unable to tell how many work orders "%s" means.' % value)
+    # if we set min duration to 1 minute, orders with incorrectly set duration of 0 will be left out
+    return max(order_minutes - LOW_TOLERANCE, 1), order_minutes + HIGH_TOLERANCE
+
+
+def print_catalog(rows):
+    """
+    Print names of scenarios in catalog rows grouped by route, return the number of rows printed
+    """
+    count = 0
+    for route, route_rows in itertools.groupby(rows, key=lambda row: row['route']):
+        print('\n * %s: \n' % route)
+        for row in route_rows:
+            print('   * %s' % row['name'])
+            count += 1
+        input('')
+    return count
+
+
+def render_fragment(order, data_folder, cache_folder=None, logo=None):
+    """
+    HTML of a single order, as rendered by order.html
+    """
+    template = get_template_environment(data_folder, cache_folder).get_template('order.html')
+    return template.render(order=order, logo_class=get_logo_class(logo))
+
+
+def render_fragments(orders, data_folder, cache_folder=None, jobs=1, logos=None):
+    """
+    Return HTML fragments of orders, showing logos given in the same order.
+
+    With cache_folder fragments are kept on disk under get_fragment_key, so a scenario is
+    only rendered again once its files or order.html change. Fragments missing from the
+    cache are rendered in a process pool of jobs processes once there are at least
+    PARALLEL_FRAGMENTS of them, a single fragment takes well under a millisecond.
+    """
+    logos = logos or [None] * len(orders)
+    keys = [None] * len(orders)
+    fragments = [None] * len(orders)
+    if cache_folder is not None:
+        fragments_folder = os.path.join(cache_folder, 'fragments')
+        ensure_folder(fragments_folder)
+        environment = get_template_environment(data_folder, cache_folder)
+        template_source = environment.loader.get_source(environment, 'order.html')[0]
+        for position, order in enumerate(orders):
+            keys[position] = get_fragment_key(order, template_source, logos[position])
+            try:
+                with open(os.path.join(fragments_folder, keys[position] + '.html'), encoding='utf-8') as f:
+                    fragments[position] = f.read()
+                profiler.tally('fragment cache hit')
+            except IOError:
+                pass
+
+    misses = [position for position, fragment in enumerate(fragments) if fragment is None]
+    if jobs > 1 and len(misses) >= PARALLEL_FRAGMENTS:
+        with get_process_pool(min(jobs, len(misses))) as executor:
+            rendered = list(executor.map(
+                functools.partial(render_fragment, data_folder=data_folder, cache_folder=cache_folder),
+                [orders[position] for position in misses],
+                [logos[position] for position in misses]
+            ))
+    else:
+        rendered = [
+            render_fragment(orders[position], data_folder, cache_folder, logos[position]) for position in misses
+        ]
+
+    for position, fragment in zip(misses, rendered):
+        profiler.tally('fragment rendered')
+        fragments[position] = fragment
+        if keys[position] is not None:
+            fragment_path = os.path.join(fragments_folder, keys[position] + '.html')
+            with open(fragment_path + '.tmp', 'w', encoding='utf-8') as f:
+                f.write(fragment)
+            os.replace(fragment_path + '.tmp', fragment_path)
+    return fragments
+
+
+def render_work_order(orders, html_path, data_folder, cache_folder=None, jobs=1, artwork=None):
+    """
+    Render the work order straight into html_path, around fragments from render_fragments.
+
+    Given an ArtworkIndex, each order shows the logo of its operator. Every logo is referenced
+    once in the document however many orders show it.
+    """
+    import pathlib
+
+    logos = [None] * len(orders)
+    if artwork is not None:
+        logos = [artwork.logo(order.route.name, order.start_datetime) for order in orders]
+    fragments = render_fragments(orders, data_folder, cache_folder, jobs, logos)
+
+    logos_folder = os.path.abspath(os.path.join(data_folder, 'Artwork', 'Logos'))
+    template = get_template_environment(data_folder, cache_folder).get_template('disposition.html')
+    stream = template.stream(
+        artwork_folder=os.path.join(data_folder, 'Artwork'),
+        fragments=fragments,
+        logos=[
+            (get_logo_class(logo), pathlib.Path(os.path.join(logos_folder, logo)).as_uri())
+            for logo in sorted(set(logos) - {None})
+        ]
+    )
+    stream.enable_buffering()
+    stream.dump(html_path)
+
+
+def report_profile(args, cprofile=None):
+    if cprofile is not None:
+        cprofile.disable()
+        cprofile.dump_stats(args.profile_output)
+    elif args.profile_output:
+        with open(args.profile_output, 'w') as f:
+            json.dump(profiler.snapshot(), f, indent=4)
+    if args.profile:
+        print(profiler.report())
+
+
+def route_xml_for(scenario_xml):
+    scenario_folder_suffix = os.path.join(*scenario_xml.split(os.sep)[-3:])
+    route_folder = scenario_xml.replace(scenario_folder_suffix, '')
+    return os.path.join(route_folder, 'RouteProperties.xml')
+
+
+def scenario_source(xml_detailed):
+    """
+    Path to read the player service from: Scenario.xml if there is one, otherwise
+    Scenario.bin next to it if it is in the Serz format
+    """
+    if not content.exists(xml_detailed):
+        xml_bin = xml_detailed[:-len('.xml')] + '.bin'
+        if is_serz(xml_bin):
+            return xml_bin
+    return xml_detailed
+
+
+def select_orders(candidates, needed, index, converter=None, scenario_filter=None, recently_driven=(),
+                  weight=None, rng=random, jobs=1, summaries=None):
+    """
+    Draw and load scenarios from candidates until needed, a number of work orders or
+    a (low, high) span of minutes as returned by parse_work_orders, is met.
+
+    Recently driven scenarios are only drawn once nothing else is left. Raise DispatcherError
+    if no combination of candidates can last as long as needed.
+    """
+    complete_orders = []
+    complete_order_duration = 0
+    fresh_candidates = [record for record in candidates if record.devstring not in recently_driven]
+    recent_candidates = [record for record in candidates if record.devstring in recently_driven]
+
+    # the index may not have known vmax or formation length of a scenario before it was loaded
+    def is_match(summary):
+        if summary is None:
+            return False
+        if scenario_filter is not None and not scenario_filter.matches(summary):
+            profiler.count('filtered once loaded')
+            return False
+        return True
+
+    if isinstance(needed, tuple):
+        solver = DurationSolver(ScenarioSampler(fresh_candidates, weight, rng), needed, rng=rng)
+        picked = solver.solve()
+        if picked is None and recent_candidates:
+            solver = DurationSolver(ScenarioSampler(candidates, weight, rng), needed, rng=rng)
+            picked = solver.solve()
+        if picked is None:
+            raise DispatcherError('No combination of scenarios lasts between %d and %d minutes. Sorry.' % needed)
+
+        while picked:
+            loader = ScenarioLoader(picked, jobs=jobs, converter=converter, summaries=summaries)
+            try:
+                orders = [order for order in (loader.load(record) for record in loader) if is_match(order)]
+            finally:
+                loader.close()
+            index.record_details(loader.details)
+            complete_orders.extend(orders)
+            complete_order_duration += sum(int(order.duration) + BREAK_LENGTH for order in orders)
+
+            # some of the picked scenarios could not be loaded, look for others to fill the gap
+            picked = solver.solve(complete_order_duration) if len(orders) < len(picked) else None
+
+    else:
+        drawn = itertools.chain(
+            ScenarioSampler(fresh_candidates, weight, rng), ScenarioSampler(recent_candidates, weight, rng))
+        loader = ScenarioLoader(drawn, jobs=jobs, converter=converter, summaries=summaries)
+        try:
+            for record in loader:
+                if len(complete_orders) >= needed:
+                    break
+
+                scenario = loader.load(record)
+                if not is_match(scenario):
+                    continue
+
+                complete_orders.append(scenario)
+        finally:
+            loader.close()
+        index.record_details(loader.details)
+
+    return complete_orders
+
+
+def steam_api(api_url, interface, method, api_key, timeout, **params):
+    import urllib.parse
+    import urllib.request
+
+    params['key'] = api_key or ''
+    url = '{0}/{1}/{2}/v1/?{3}'.format(api_url.rstrip('/'), interface, method, urllib.parse.urlencode(params))
+    response = urllib.request.urlopen(url, timeout=timeout)
+    try:
+        return json.loads(response.read().decode('utf-8'))
+    finally:
+        response.close()
+
+
 def to_minutes(time_string):
     pattern = re.compile('(?P<inte>[0-9\.]{1,4})(?P<stri>[hm]{1})')
     try:
@@ -379,33 +2908,105 @@ def to_minutes(time_string):
         raise ValueError('Value %s does not meet the expected format.' % time_string)
 
 
-def _main():
-
-    complete_orders = []
+def write_batch(profiles, index, data_folder, cache_folder=None, converter=None, expressions=(), artwork=None,
+                rng=random, jobs=1):
     """
-    Work orders generated
+    Write a work order for every BatchProfile, return (profile, HTML path, error) for each.
+
+    Scenarios are loaded at most once for the whole batch. A scenario given to a driver is
+    left out for the following ones, identical copies of it included, unless their profile
+    sets share_scenarios.
     """
-    complete_order_duration = 0
+    summaries = {}
+    # identities of given scenarios, paths of those without one
+    assigned = set()
+    keys = dict((record.path, record.identity or record.path) for record in index.records())
+    written = []
+    for profile in profiles:
+        try:
+            work_orders = profile.work_orders()
+            if work_orders is None:
+                raise DispatcherError('Already drove the planned hours.')
+            needed = parse_work_orders(work_orders)
+            scenario_filter = get_scenario_filter(profile.config, expressions)
+            recently_driven, exclude_recent = get_recently_driven(profile.config, profile.ledger)
+            is_candidate = get_candidate_check(
+                profile.config.get('ignored_scenarios') or [], recently_driven, exclude_recent)
+            candidates = [
+                record for record in index.records(scenario_filter)
+                if (profile.share_scenarios or keys[record.path] not in assigned) and is_candidate(record)
+            ]
+            weight = get_sampling_weight(profile.config.get('sampling') or {}, candidates,
+                                         profile.ledger.last_driven())
+            orders = select_orders(
+                candidates, needed, index, converter=converter, scenario_filter=scenario_filter,
+                recently_driven=recently_driven, weight=weight, rng=rng, jobs=jobs, summaries=summaries
+            )
+            if not orders:
+                raise DispatcherError('Not able to generate any scenario meeting the requirements.')
+        except DispatcherError as exc:
+            written.append((profile, None, str(exc)))
+            continue
+        # debug_filenames[1] is the path of the record the order was loaded from
+        assigned.update(keys[order.debug_filenames[1]] for order in orders)
+        html_path = write_work_order(
+            orders, profile.ledger, profile.work_orders_folder, data_folder, cache_folder, jobs, artwork)
+        written.append((profile, html_path, None))
+    return written
+
+
+def write_catalog(rows, output, output_format='ndjson'):
     """
-    How many minutes will generated work orders take
+    Write catalog rows to output as they come, return the number of rows written
     """
+    if output_format == 'csv':
+        import csv
+        writer = csv.DictWriter(output, CATALOG_FIELDS, lineterminator='\n')
+        writer.writeheader()
+        write = writer.writerow
+    else:
+        write = lambda row: output.write(json.dumps(row) + '\n')
+
+    count = 0
+    for row in rows:
+        write(row)
+        count += 1
+    return count
 
-    needed_order_count = None
+
+def write_work_order(orders, ledger, work_orders_folder, data_folder, cache_folder=None, jobs=1, artwork=None):
     """
-    How many work orders should be generated
+    Render orders under the next free number and record them in the ledger, return the HTML path
     """
-    needed_order_duration_span = None
+    last_number = ledger.last_number()
+    if last_number is None:
+        # first run with the ledger, carry on from the existing work orders
+        last_number = get_last_number(work_orders_folder)
+    last_work_order_number = last_number + len(orders)
+
+    html_name = str(last_work_order_number).zfill(4) + '.html'
+    html_path = os.path.join(work_orders_folder, html_name)
+    with profiler.phase('render'):
+        render_work_order(orders, html_path, data_folder, cache_folder, jobs, artwork)
+    ledger.append(last_work_order_number, [order.devstring for order in orders])
+    return html_path
+
+
+def _main():
+
+    complete_orders = []
     """
-    How many minutes should work orders take
+    Work orders generated
     """
 
-    default_route_config = None
+    needed = None
     """
-    Route artwork config to use when given route is not present in route_configs
+    How many work orders should be generated, or (low, high) minutes they should take
     """
-    route_configs = None
+
+    artwork = None
     """
-    A dictionary of route artwork configs, indexed by route name
+    Operator logos by route and date, from artwork.yaml
     """
 
     ignored_scenarios = None
@@ -425,46 +3026,160 @@ def _main():
         filename=logfile, format='\n%(asctime)-15s %(levelname)-8s %(message)s', level=loglevel
     )
 
-    configfile = ensure_config_present(railworks_folder)
-    config = yaml.load(open(configfile))
-    logging.debug('Loaded config: %s' % config)
+    if args.profile or args.profile_output:
+        cprofile = None
+        if args.profile_output and not args.profile_output.endswith('.json'):
+            import cProfile
+            cprofile = cProfile.Profile()
+            cprofile.enable()
+        atexit.register(report_profile, args, cprofile)
 
-    ignored_scenarios = config['ignored_scenarios'] or []
+    if args.work_orders == 'serve':
+        DispatcherService(railworks_folder, jobs=args.jobs).serve(args.host, args.port)
+        return
 
-    scenario_folders = os.path.join(railworks_folder,
-                                    'Content', 'Routes', '*', 'Scenarios', '*', 'ScenarioProperties.xml')
+    routes_folder = os.path.join(railworks_folder, 'Content', 'Routes')
     work_orders_folder = os.path.join(railworks_folder, 'WorkOrders')
     ensure_folder(work_orders_folder)
+    cache_folder = os.path.join(railworks_folder, 'dispatcher.cache')
 
     dispatcher_folder = os.path.abspath(os.path.dirname(__file__))
     dispatcher_data_folder = os.path.join(dispatcher_folder, 'Dispatcher')
-    dispatcher_artwork_folder = os.path.join(dispatcher_data_folder, 'Artwork')
 
-    all_scenarios = glob.glob(scenario_folders)
-    random.shuffle(all_scenarios)
+    index = ScenarioIndex(os.path.join(railworks_folder, 'dispatcher.sqlite'))
+
+    configfile = ensure_config_present(railworks_folder)
+    with profiler.phase('load config'):
+        config = load_config(configfile, index)
+    logging.debug('Loaded config: %s' % config)
+
+    ignored_scenarios = config.get('ignored_scenarios') or []
+
+    ledger = Ledger(os.path.join(work_orders_folder, 'ledger.sqlite'))
+
+    try:
+        scenario_filter = get_scenario_filter(config, args.filter)
+        recently_driven, exclude_recent = get_recently_driven(config, ledger)
+    except DispatcherError as exc:
+        die(str(exc))
+    if scenario_filter:
+        no_scenarios_message = 'No scenarios match the filters. Sorry.'
+    else:
+        no_scenarios_message = 'No scenarios found. Are you sure you are running dispatcher from the correct folder?'
+
+    # scenarios from missing and ignored routes are not even indexed
+    is_candidate = get_candidate_check(ignored_scenarios, recently_driven, exclude_recent)
 
-    steam.api.key.set(STEAM_API_KEY)
+    # ask Steam while the scenarios are being scanned
+    steam_config = config.get('steam') or {}
+    steam_lookup = None
+    profiles = []
+    if args.batch:
+        try:
+            profiles = [BatchProfile(profile_config, config, work_orders_folder, index)
+                        for profile_config in config.get('profiles') or []]
+        except DispatcherError as exc:
+            die(str(exc))
+        if not profiles:
+            die('There are no profiles in dispatcher.yaml to make work orders for.')
+        for profile in profiles:
+            profile.start()
+    elif args.work_orders is None and not (args.catalog or args.list or args.preconvert):
+        steam_lookup = get_steam_lookup(steam_config, index)
+        if steam_lookup is not None:
+            steam_lookup.start()
+
+    with profiler.phase('scan'):
+        scanner = ContentScanner(index, rescan=args.rescan)
+        scenario_xmls, stats = scanner.scan(routes_folder)
+    with profiler.phase('refresh index'):
+        index.refresh(scenario_xmls, ignored_routes=IGNORED_ROUTES, stats=stats)
+
+    # catalog and list are streamed from the index one scenario at a time
+    if args.catalog or args.list:
+        with profiler.phase('catalog'):
+            if args.catalog:
+                loader = ScenarioLoader(index.iter_records(scenario_filter), jobs=args.jobs)
+                try:
+                    with open(args.catalog, 'w', newline='', encoding='utf-8') as f:
+                        count = write_catalog(catalog_rows(loader, scenario_filter), f,
+                                              output_format='csv' if args.catalog.endswith('.csv') else 'ndjson')
+                finally:
+                    loader.close()
+                index.record_details(loader.details)
+                print('%d scenario(s) written to %s' % (count, args.catalog))
+            else:
+                count = print_catalog(
+                    catalog_row(record) for record in index.iter_records(scenario_filter) if is_candidate(record))
+        index.close()
+        ledger.close()
+        if not count:
+            die(no_scenarios_message)
+        exit_banner()
+        return
+
+    rng = random.Random(args.seed)
+    with profiler.phase('query index'):
+        all_scenarios = index.records(scenario_filter)
+
+    converter = get_converter(railworks_folder, config, index)
+
+    if args.preconvert:
+        conversions = []
+        failed_before = 0
+        for record in all_scenarios:
+            if not content.exists(record.xml_detailed) and converter.failed_before(record.xml_detailed):
+                failed_before += 1
+                continue
+            conversion = converter.submit(record.xml_detailed)
+            if conversion is not None:
+                conversions.append(conversion)
+        print('Converting %d scenario(s)...' % len(conversions))
+        converted = len([conversion for conversion in conversions if conversion.result()])
+        print('%d converted, %d failed, %d skipped, failed before. See dispatcher.log for details.' % (
+            converted, len(conversions) - converted, failed_before))
+        converter.close()
+        index.record_conversion_failures(converter.new_failures)
+        index.close()
+        exit_banner()
+        return
 
     if not all_scenarios:
-        die('No scenarios found. Are you sure you are running dispatcher from the correct folder?')
+        die(no_scenarios_message)
 
-    if args.list:
-        args.work_orders = len(all_scenarios)
+    artwork = load_artwork(os.path.join(dispatcher_data_folder, 'artwork.yaml'), index)
+
+    if profiles:
+        try:
+            with profiler.phase('batch'):
+                written = write_batch(
+                    profiles, index, dispatcher_data_folder, cache_folder, converter=converter,
+                    expressions=args.filter, artwork=artwork, rng=rng, jobs=args.jobs
+                )
+        finally:
+            converter.close()
+            index.record_conversion_failures(converter.new_failures)
+            index.close()
+            for profile in profiles:
+                profile.close()
+        for profile, html_path, error in written:
+            print('%s: %s' % (profile.name, html_path or error))
+        ledger.close()
+        exit_banner()
+        return
 
     if args.work_orders is None:
         steam_minutes_less = None
 
         try:
-            steam_config = dictget(config, 'steam')
-            steam_profile = steam_config['profile']
             steam_hours_planned = steam_config['hours_two_weeks']
 
-            assert steam_profile and steam_hours_planned
+            assert steam_lookup and steam_hours_planned
 
-            if isinstance(steam_profile, str) and not steam_profile.isnumeric():
-                steam_profile = get_steam_profile_id(steam_profile)
+            with profiler.phase('steam'):
+                steam_minutes_played = steam_lookup.minutes_played()
 
-            steam_minutes_played = get_steam_minutes_played(steam_profile)
+            assert steam_minutes_played is not None
             steam_minutes_less = steam_hours_planned * 60 - steam_minutes_played
 
         except Exception as exc:
@@ -472,7 +3187,7 @@ def _main():
 
         else:
             logging.debug('Steam profile %s played %d minutes out of %d in last 2 weeks' %
-                          (steam_profile, steam_minutes_played, steam_hours_planned * 60))
+                          (steam_lookup.profile, steam_minutes_played, steam_hours_planned * 60))
             print('According to Steam you played roughly %d hour(s) in the last two weeks.' % (steam_minutes_played / 60))
             print('That\'s %d minutes less than the planned %d hours.' % (steam_minutes_less, steam_hours_planned))
             print('You can just hit <Enter> to create the missing work orders.\n')
@@ -485,98 +3200,35 @@ def _main():
         args.work_orders = input('... [default: %s] ' % default) or default
 
     try:
-        order_minutes = to_minutes(args.work_orders)
-        # if we set min duration to 1 minute, orders with incorrectly set duration of 0 will be left out
-        needed_order_duration_span = (max(order_minutes - LOW_TOLERANCE, 1), order_minutes + HIGH_TOLERANCE)
-        logging.debug('Required %d minutes. Will generate between %d and %d' % (order_minutes, needed_order_duration_span[0], needed_order_duration_span[1]))
-
-    except (TypeError, ValueError):
-        needed_order_count = int(args.work_orders)
-        logging.debug('Required %d work orders')
-
-    def should_continue(completed_list, duration):
-        if needed_order_count is not None:
-            return len(completed_list) < needed_order_count
-        else:
-            return not(needed_order_duration_span[0] < duration < needed_order_duration_span[1])
-
-    logging.debug('Will create scenarios with following constraints: %s' % {
-        'needed_order_count': needed_order_count,
-        'needed_order_duration_span': needed_order_duration_span
-    })
-
-    while all_scenarios and should_continue(complete_orders, complete_order_duration):
+        needed = parse_work_orders(args.work_orders)
+    except DispatcherError as exc:
+        die(str(exc))
+    logging.debug('Will create scenarios with following constraints: %s' % {'needed': needed})
 
-        todays_work_order = all_scenarios[-1]
-        all_scenarios.pop()
+    candidates = [record for record in all_scenarios if is_candidate(record)]
+    weight = get_sampling_weight(config.get('sampling') or {}, candidates, ledger.last_driven())
 
-        # only allow scenarios from existing unpacked routes
-        scenario_folder_suffix = os.path.join(*todays_work_order.split(os.sep)[-3:])
-        route_folder = todays_work_order.replace(scenario_folder_suffix, '')
-        route_description = os.path.join(route_folder, 'RouteProperties.xml')
-        if not os.path.exists(route_description):
-            continue
-
-        # check if Scenario.bin was already unpacked to Scenario.xml
-        todays_work_order_details = todays_work_order.replace('ScenarioProperties.xml', 'Scenario.xml')
-        if not os.path.isfile(todays_work_order_details):
-            todays_work_order_bin = todays_work_order_details.replace('.xml', '.bin')
-            subprocess.check_output('.\Serz.exe %s' % todays_work_order_bin.replace(railworks_folder, '').strip(os.sep))
-
-        try:
-            scenario = Scenario(todays_work_order, todays_work_order_details, route_description)
-        except Exception:
-            continue
-
-        if scenario.route.name in IGNORED_ROUTES:
-            continue
-
-        if scenario.scenario_class in IGNORED_SCENARIO_CLASSES:
-            continue
-
-        if scenario.devstring in ignored_scenarios:
-            logging.debug('Skipping scenario {} because scenario ignored'.format(scenario))
-            continue
-
-        if (needed_order_duration_span is not None and
-            complete_order_duration + scenario.duration > needed_order_duration_span[1]):
-            continue
-
-        if not scenario.name:
-            continue
-
-        complete_orders.append(scenario)
-        complete_order_duration += int(scenario.duration) + BREAK_LENGTH
+    try:
+        with profiler.phase('select'):
+            complete_orders = select_orders(
+                candidates, needed, index, converter=converter, scenario_filter=scenario_filter,
+                recently_driven=recently_driven, weight=weight, rng=rng, jobs=args.jobs
+            )
+    except DispatcherError as exc:
+        die(str(exc))
+    finally:
+        converter.close()
+        index.record_conversion_failures(converter.new_failures)
+        index.close()
 
     if not complete_orders:
         die('Not able to generate any scenario meeting your requirements. Sorry.')
 
-    # Output html only if not list mode
-    if not args.list:
-        last_work_order_number = str(get_last_number(work_orders_folder) + len(complete_orders)).zfill(4)
-
-        template = os.path.join(dispatcher_data_folder, 'Templates', 'disposition.html')
-        html = jinja2.Template(open(template).read()).render(
-            artwork_folder=dispatcher_artwork_folder,
-            orders=complete_orders
-        )
-
-        html_name = last_work_order_number + '.html'
-        html_path = os.path.join(work_orders_folder, html_name)
-        open(html_path, 'w').write(html)
-        launch_html(html_path)
-
-    # In list mode output scenarios grouped by route name
-    else:
-        route_name_getter = lambda order: order.route.name
-        sorted_orders = sorted(complete_orders, key=route_name_getter)
-        grouped_orders = itertools.groupby(sorted_orders, key=route_name_getter)
-        for route, orders in grouped_orders:
-            print('\n * %s: \n' % route)
-            for order_context in orders:
-                print('   * %s' % order_context['scenario_name'])
-            input('')
+    html_path = write_work_order(
+        complete_orders, ledger, work_orders_folder, dispatcher_data_folder, cache_folder, args.jobs, artwork)
+    launch_html(html_path)
 
+    ledger.close()
     exit_banner()
 
 
@@ -36,7 +36,7 @@ setup(
     license='MIT License',
 
     version='0.5.1',
-    install_requires=['jinja2', 'PyYAML', 'steamodd', 'xmltodict'],
+    install_requires=['jinja2', 'PyYAML', 'xmltodict>=1.0.0'],
     platforms=['Windows', 'POSIX'],
 
     entry_points={
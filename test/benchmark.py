@@ -0,0 +1,332 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Benchmarks dispatcher.py against a synthetic Railworks tree and reports the timings as JSON.
+
+    python test/benchmark.py --routes 20 --scenarios 50 --output bench.json
+    python test/benchmark.py --routes 20 --scenarios 50 --compare bench.json
+
+Whole runs of the dispatcher are timed in a fresh interpreter, cold (without the scenario
+index and template cache and with Scenario.bin files still to be converted) and warm, and
+any of them failing fails the benchmark. Scenario parsing and template rendering, with and
+without cached fragments, are timed in-process, as is reading every Scenario.xml encoded
+to the Serz format, which has to give the same player service.
+Importing dispatcher is timed against a bare interpreter and must stay within
+--import-budget, without pulling in any of LAZY_MODULES.
+"""
+
+import argparse
+import glob
+import json
+import os
+import platform
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import synthetic
+
+
+REPOSITORY_FOLDER = os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir))
+
+sys.path.insert(0, REPOSITORY_FOLDER)
+import dispatcher  # noqa: E402
+
+
+CONFIG = """
+ignored_scenarios: []
+converter:
+  native: true
+  command: '"{python}" -c "import shutil, sys; shutil.copyfile(sys.argv[1], sys.argv[2])" {{bin}} {{xml}}'
+  timeout: 60
+  jobs: 2
+"""
+
+RUNNER = """
+import builtins, sys
+sys.path.insert(0, {repository!r})
+import dispatcher
+dispatcher.launch_html = lambda path: None
+builtins.input = lambda prompt='': ''
+sys.argv = ['dispatcher'] + {args!r}
+dispatcher._main()
+"""
+
+IMPORTER = """
+import json, sys
+sys.path.insert(0, {repository!r})
+import dispatcher
+print(json.dumps(sorted(set({lazy_modules!r}) & set(sys.modules))))
+"""
+
+LAZY_MODULES = (
+    'concurrent.futures', 'csv', 'jinja2', 'subprocess', 'urllib.request', 'xmltodict', 'yaml', 'zipfile',
+)
+
+MAIN_MODES = (
+    ('count', ['3']),
+    ('duration', ['2h']),
+    ('list', ['--list']),
+)
+
+
+class Benchmark(object):
+
+    railworks_folder = None
+    repeat = None
+    results = None
+
+    def __init__(self, railworks_folder, repeat=3, jobs=1):
+        self.railworks_folder = railworks_folder
+        self.repeat = repeat
+        self.jobs = jobs
+        self.results = {}
+
+    def add(self, name, seconds, **extra):
+        result = self.results.setdefault(name, {'runs': []})
+        result['runs'].append(seconds)
+        result['min'] = min(result['runs'])
+        result['median'] = statistics.median(result['runs'])
+        result.update(extra)
+
+    def make_cold(self):
+        index = os.path.join(self.railworks_folder, 'dispatcher.sqlite')
+        if os.path.exists(index):
+            os.remove(index)
+        # compiled templates, cached fragments and work orders of previous runs
+        for folder in ('dispatcher.cache', 'WorkOrders'):
+            shutil.rmtree(os.path.join(self.railworks_folder, folder), ignore_errors=True)
+        # drop conversions made by previous runs
+        for xml_bin in self.glob('Scenario.bin'):
+            xml_detailed = xml_bin[:-len('.bin')] + '.xml'
+            if os.path.exists(xml_detailed):
+                os.remove(xml_detailed)
+
+    def glob(self, name):
+        return glob.glob(os.path.join(self.railworks_folder, 'Content', 'Routes', '*', 'Scenarios', '*', name))
+
+    def run(self):
+        self.run_startup()
+        for mode, args in MAIN_MODES:
+            args = args + ['--jobs', str(self.jobs)]
+            for _ in range(self.repeat):
+                self.make_cold()
+                self.add('main_%s_cold' % mode, self.run_main(args))
+                self.add('main_%s_warm' % mode, self.run_main(args))
+        self.run_parsing()
+        self.run_serz()
+        self.run_rendering()
+        return self.results
+
+    def run_main(self, args):
+        started = time.perf_counter()
+        process = subprocess.run(
+            [sys.executable, '-c', RUNNER.format(repository=REPOSITORY_FOLDER, args=args)],
+            cwd=self.railworks_folder, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE
+        )
+        elapsed = time.perf_counter() - started
+        if process.returncode:
+            # a failed run is no timing at all
+            sys.exit('dispatcher %s failed: %s' % (' '.join(args), process.stderr.decode()))
+        return elapsed
+
+    def records(self):
+        index = dispatcher.ScenarioIndex(os.path.join(self.railworks_folder, 'dispatcher.sqlite'))
+        index.refresh(self.glob('ScenarioProperties.xml'), ignored_routes=dispatcher.IGNORED_ROUTES)
+        records = [record for record in index.records() if os.path.isfile(record.xml_detailed)]
+        index.close()
+        return records
+
+    def run_startup(self):
+        importer = IMPORTER.format(repository=REPOSITORY_FOLDER, lazy_modules=LAZY_MODULES)
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            subprocess.check_call([sys.executable, '-c', 'pass'])
+            self.add('interpreter', time.perf_counter() - started)
+
+            started = time.perf_counter()
+            output = subprocess.check_output([sys.executable, '-c', importer])
+            self.add('import', time.perf_counter() - started, eager_modules=json.loads(output.decode()))
+
+    def run_parsing(self):
+        records = self.records()
+        parsed_bytes = sum(os.path.getsize(record.xml_detailed) for record in records)
+        for _ in range(self.repeat):
+            started = time.perf_counter()
+            for record in records:
+                dispatcher.parse_scenario(record)
+            elapsed = time.perf_counter() - started
+            self.add('scenario_parsing', elapsed, scenarios=len(records), bytes=parsed_bytes)
+
+    def run_serz(self):
+        records = self.records()
+        with tempfile.TemporaryDirectory() as folder:
+            pairs = []
+            for position, record in enumerate(records):
+                xml_bin = os.path.join(folder, '%d.bin' % position)
+                with open(record.xml_detailed, encoding='utf-8') as f, open(xml_bin, 'wb') as output:
+                    output.write(synthetic.serz(f.read()))
+                pairs.append((record.xml_detailed, xml_bin))
+            parsed_bytes = sum(os.path.getsize(xml_bin) for _, xml_bin in pairs)
+
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                for _, xml_bin in pairs:
+                    dispatcher.parse_player_consist(xml_bin)
+                elapsed = time.perf_counter() - started
+                self.add('serz_parsing', elapsed, scenarios=len(pairs), bytes=parsed_bytes)
+
+            mismatches = [
+                xml_detailed for xml_detailed, xml_bin in pairs
+                if without_attributes(dispatcher.parse_player_consist(xml_detailed)) !=
+                without_attributes(dispatcher.parse_player_consist(xml_bin))
+            ]
+        self.results['serz_parsing']['mismatches'] = mismatches
+
+    def run_rendering(self):
+        orders = [order for order in map(dispatcher.parse_scenario, self.records()) if order is not None]
+        data_folder = os.path.join(REPOSITORY_FOLDER, 'Dispatcher')
+        with tempfile.TemporaryDirectory() as folder:
+            html_path = os.path.join(folder, '0001.html')
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                dispatcher.render_work_order(orders, html_path, data_folder)
+                elapsed = time.perf_counter() - started
+                self.add('template_rendering', elapsed, orders=len(orders))
+
+            # fragments of every order are cached by the first run
+            cache_folder = os.path.join(folder, 'cache')
+            dispatcher.render_work_order(orders, html_path, data_folder, cache_folder)
+            for _ in range(self.repeat):
+                started = time.perf_counter()
+                dispatcher.render_work_order(orders, html_path, data_folder, cache_folder)
+                elapsed = time.perf_counter() - started
+                self.add('template_rendering_cached', elapsed, orders=len(orders))
+
+
+def compare(results, baseline, threshold):
+    """
+    Print medians next to the baseline ones, return names of results slower than threshold allows
+    """
+    regressions = []
+    for name, result in sorted(results.items()):
+        previous = baseline.get(name)
+        if previous is None:
+            print('%-24s %8.3fs' % (name, result['median']))
+            continue
+        ratio = result['median'] / previous['median'] if previous['median'] else float('inf')
+        print('%-24s %8.3fs %8.3fs %6.2fx' % (name, result['median'], previous['median'], ratio))
+        if ratio > threshold:
+            regressions.append(name)
+    return regressions
+
+
+def check_serz(results):
+    """
+    Return Scenario.xml files whose player service read differently once encoded to the Serz format
+    """
+    mismatches = results['serz_parsing']['mismatches']
+    print('%-24s %8d of %d' % ('serz mismatches', len(mismatches), results['serz_parsing']['scenarios']))
+    return ['serz mismatch in %s' % xml_detailed for xml_detailed in mismatches]
+
+
+def check_import(results, budget):
+    """
+    Return problems with importing dispatcher: time over budget or modules that should load lazily
+    """
+    problems = []
+    overhead = results['import']['median'] - results['interpreter']['median']
+    print('%-24s %8.3fs (budget %.3fs)' % ('import overhead', overhead, budget))
+    if overhead > budget:
+        problems.append('import overhead')
+    if results['import']['eager_modules']:
+        problems.append('eagerly imported %s' % ', '.join(results['import']['eager_modules']))
+    return problems
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPOSITORY_FOLDER, stderr=subprocess.DEVNULL
+        ).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Benchmark dispatcher.py on a synthetic Railworks tree.')
+    parser.add_argument('--tree', help='use this Railworks folder instead of generating one')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--jobs', type=int, default=1, help='passed on to dispatcher --jobs')
+    parser.add_argument('--output', help='write the JSON report here instead of stdout')
+    parser.add_argument('--compare', help='JSON report of a previous run to compare against')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='slowdown against --compare that counts as a regression')
+    parser.add_argument('--import-budget', type=float, default=0.1,
+                        help='seconds importing dispatcher may take on top of a bare interpreter')
+    synthetic.add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def main():
+    args = parse_args()
+
+    folder = args.tree or tempfile.mkdtemp(prefix='railworks-')
+    try:
+        tree = {'folder': folder}
+        if not args.tree:
+            synthetic.generator_from_args(folder, args).generate()
+            tree.update(dict(
+                (option, getattr(args, option)) for option in (
+                    'routes', 'scenarios', 'consists', 'instructions', 'vehicles', 'padding',
+                    'missing_route', 'missing_scenario_xml', 'duplicates', 'seed')
+            ))
+            with open(os.path.join(folder, 'dispatcher.yaml'), 'w') as f:
+                f.write(CONFIG.format(python=sys.executable))
+
+        results = Benchmark(folder, repeat=args.repeat, jobs=args.jobs).run()
+        report = json.dumps({
+            'commit': git_commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'tree': tree,
+            'results': results,
+        }, indent=2, sort_keys=True)
+
+        if args.output:
+            with open(args.output, 'w') as f:
+                f.write(report)
+        elif not args.compare:
+            print(report)
+
+        regressions = check_import(results, args.import_budget) + check_serz(results)
+        if args.compare:
+            with open(args.compare) as f:
+                baseline = json.load(f)['results']
+            regressions += compare(results, baseline, args.threshold)
+        if regressions:
+            print('Regressions: %s' % ', '.join(regressions), file=sys.stderr)
+            sys.exit(1)
+
+    finally:
+        if not args.tree:
+            shutil.rmtree(folder, ignore_errors=True)
+
+
+def without_attributes(item):
+    """
+    Elements as parsed by xmltodict, without attributes such as d:alt_encoding that Scenario does not read
+    """
+    if isinstance(item, list):
+        return [without_attributes(child) for child in item]
+    if isinstance(item, dict):
+        return dict((key, without_attributes(value)) for key, value in item.items() if not key.startswith('@'))
+    return item
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,424 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Generates a synthetic Railworks Content/Routes tree for benchmarking dispatcher.py.
+
+Routes, scenarios and consists are made up, but laid out and tagged the way Railworks
+does it, so that every code path of the dispatcher can be exercised at scale:
+
+    python test/synthetic.py /tmp/railworks --routes 20 --scenarios 50 --consists 40
+
+Scenarios shipping Scenario.bin only get it in the Serz binary format, encoded from the
+Scenario.xml they would have had by serz().
+"""
+
+import argparse
+import os
+import random
+import struct
+import sys
+import uuid
+import xml.etree.ElementTree
+from xml.sax.saxutils import escape
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+from dispatcher import SERZ_DEFINITION_SLOTS, SERZ_MAGIC, SERZ_VALUE_FORMATS  # noqa: E402
+
+
+DELTA = '{http://www.kuju.com/TnT/2003/Delta}'
+
+LOCALISED = """<{tag}>
+<Localisation-cUserLocalisedString>
+<English d:type="cDeltaString">{text}</English>
+<Other/>
+<Key d:type="cDeltaString">{key}</Key>
+</Localisation-cUserLocalisedString>
+</{tag}>"""
+
+ROUTE_PROPERTIES = """<?xml version="1.0" encoding="utf-8"?>
+<cRouteProperties xmlns:d="http://www.kuju.com/TnT/2003/Delta" d:version="1.0" d:id="1">
+<ID>
+<cGUID>
+<UUID>
+<e d:type="sUInt64">{uuid0}</e>
+<e d:type="sUInt64">{uuid1}</e>
+</UUID>
+<DevString d:type="cDeltaString">{devstring}</DevString>
+</cGUID>
+</ID>
+{display_name}
+</cRouteProperties>
+"""
+
+SCENARIO_PROPERTIES = """<?xml version="1.0" encoding="utf-8"?>
+<cScenarioProperties xmlns:d="http://www.kuju.com/TnT/2003/Delta" d:version="1.0" d:id="1">
+<ID>
+<cGUID>
+<UUID>
+<e d:type="sUInt64">{uuid0}</e>
+<e d:type="sUInt64">{uuid1}</e>
+</UUID>
+<DevString d:type="cDeltaString">{devstring}</DevString>
+</cGUID>
+</ID>
+{display_name}
+{description}
+{briefing}
+{start_location}
+<ScenarioClass d:type="cDeltaString">{scenario_class}</ScenarioClass>
+<StartTime d:type="sFloat32" d:precision="string">{start_time}</StartTime>
+<DurationMins d:type="sInt32">{duration}</DurationMins>
+<StartDD d:type="sInt32">{day}</StartDD>
+<StartMM d:type="sInt32">{month}</StartMM>
+<StartYYYY d:type="sInt32">{year}</StartYYYY>
+<FrontEndDriverList>
+<sDriverFrontEndDetails d:id="2">
+{service_name}
+<PlayerDriver d:type="bool">1</PlayerDriver>
+</sDriverFrontEndDetails>
+</FrontEndDriverList>
+</cScenarioProperties>
+"""
+
+CONSIST = """<cConsist d:id="{id}">
+<RailVehicles>
+{vehicles}
+</RailVehicles>
+<MaxPermissibleSpeed d:type="sFloat32" d:precision="string">{max_speed}</MaxPermissibleSpeed>
+<Driver>
+<cDriver d:id="{driver_id}">
+{service_name}
+<PlayerDriver d:type="bool">{player}</PlayerDriver>
+<InitialRV>
+{initial_rv}
+</InitialRV>
+<DriverInstructionContainer>
+<cDriverInstructionContainer d:id="{container_id}">
+<DriverInstruction>
+{instructions}
+</DriverInstruction>
+</cDriverInstructionContainer>
+</DriverInstructionContainer>
+</cDriver>
+</Driver>
+</cConsist>"""
+
+INSTRUCTION_TARGET = """<cDriverInstructionTarget d:id="{id}">
+<DisplayName d:type="cDeltaString">{location}</DisplayName>
+<Duration d:type="sFloat32" d:precision="string">{duration}</Duration>
+<DueTime d:type="sFloat64" d:precision="string">{due_time}</DueTime>
+<Operation d:type="cDeltaString">{operation}</Operation>
+<PickingUp d:type="bool">{picking_up}</PickingUp>
+<Waypoint d:type="bool">{waypoint}</Waypoint>
+<MinSpeed d:type="sInt32">0</MinSpeed>
+<RailVehicleNumber>
+<e d:type="cDeltaString">{vehicle}</e>
+</RailVehicleNumber>
+</cDriverInstructionTarget>"""
+
+RAIL_VEHICLE = """<cOwnedEntity d:id="{id}">
+<Name d:type="cDeltaString">{name}</Name>
+<Padding d:type="cDeltaString">{padding}</Padding>
+<Scale d:numElements="3" d:elementType="sFloat32" d:precision="string">1 1 0.5</Scale>
+<Consist d:type="ref">{consist_id}</Consist>
+</cOwnedEntity>"""
+
+SCENARIO = """<?xml version="1.0" encoding="utf-8"?>
+<cRecordSet xmlns:d="http://www.kuju.com/TnT/2003/Delta" d:version="1.0" d:id="1">
+<Record>
+{consists}
+</Record>
+</cRecordSet>
+"""
+
+SCENARIO_CLASSES = (
+    ('eTimetableScenarioClass', 60),
+    ('eStandardScenarioClass', 30),
+    ('eFreeRoamScenarioClass', 5),
+    ('eTemplateScenarioClass', 3),
+    ('eTutorialScenarioClass', 2),
+)
+
+STATIONS = (
+    'Bishops Stortford', 'Cambridge', 'Chelmsford', 'Colchester', 'Harlow Town', 'Ipswich',
+    'Liverpool Street', 'Manningtree', 'Shenfield', 'Stratford', 'Witham', 'Ely',
+)
+
+
+class Generator(object):
+    """
+    Builds the tree. All randomness comes from one seeded Random, so that the same
+    arguments always produce the same tree.
+    """
+
+    def __init__(self, target, routes=5, scenarios=20, consists=10, instructions=8, vehicles=6,
+                 padding=0, missing_route=0.0, missing_scenario_xml=0.0, duplicates=0.0, seed=1):
+        self.target = target
+        self.routes = routes
+        self.scenarios = scenarios
+        self.consists = consists
+        self.instructions = instructions
+        self.vehicles = vehicles
+        self.padding = padding
+        self.missing_route = missing_route
+        self.missing_scenario_xml = missing_scenario_xml
+        self.duplicates = duplicates
+        self.random = random.Random(seed)
+        self.next_id = 100
+
+    def generate(self):
+        routes_folder = os.path.join(self.target, 'Content', 'Routes')
+        generated = []
+        for route_number in range(self.routes):
+            route_folder = os.path.join(routes_folder, self.guid())
+            os.makedirs(os.path.join(route_folder, 'Scenarios'))
+            if self.random.random() >= self.missing_route:
+                self.write(os.path.join(route_folder, 'RouteProperties.xml'), self.route(route_number))
+            for scenario_number in range(self.scenarios):
+                if generated and self.random.random() < self.duplicates:
+                    # same scenario folder GUID and content, repackaged under another route
+                    source_folder, scenario_guid = self.random.choice(generated)
+                    duplicate_folder = os.path.join(route_folder, 'Scenarios', scenario_guid)
+                    if not os.path.exists(duplicate_folder):
+                        self.copy_scenario(source_folder, duplicate_folder)
+                        continue
+                scenario_guid = self.guid()
+                scenario_folder = os.path.join(route_folder, 'Scenarios', scenario_guid)
+                os.makedirs(scenario_folder)
+                self.write_scenario(scenario_folder, scenario_guid, route_number, scenario_number)
+                generated.append((scenario_folder, scenario_guid))
+        return generated
+
+    def copy_scenario(self, source, target):
+        os.makedirs(target)
+        for name in os.listdir(source):
+            with open(os.path.join(source, name), 'rb') as f:
+                self.write(os.path.join(target, name), f.read())
+
+    def consist(self, player, service_name):
+        vehicles = ['{0}{1:03d}'.format(self.random.randint(100, 999), n) for n in range(self.vehicles)]
+        due_time = self.random.randint(600, 1200)
+        instructions = []
+        for _ in range(self.instructions if player else self.random.randint(1, self.instructions)):
+            due_time += self.random.randint(120, 900)
+            instructions.append(
+                '<cStopAtDestinations d:id="{id}">\n<DeltaTarget>\n{target}\n</DeltaTarget>\n'
+                '</cStopAtDestinations>'.format(
+                    id=self.id(),
+                    target=INSTRUCTION_TARGET.format(
+                        id=self.id(),
+                        location=self.random.choice(STATIONS),
+                        duration=self.random.choice((30, 45, 60, 120)),
+                        due_time=due_time,
+                        operation=self.random.choice(('Default',) * 8 + ('AddToBack', 'DropOffRailVehicle')),
+                        picking_up=self.random.choice((0, 1, 1, 1)),
+                        waypoint=self.random.choice((0, 0, 0, 1)),
+                        vehicle=self.random.choice(vehicles),
+                    )
+                )
+            )
+        consist_id = self.id()
+        return CONSIST.format(
+            id=consist_id,
+            vehicles='\n'.join(
+                RAIL_VEHICLE.format(id=self.id(), name=vehicle, padding='x' * self.padding, consist_id=consist_id)
+                for vehicle in vehicles
+            ),
+            max_speed=self.random.choice((120, 160, 176, 200)),
+            driver_id=self.id(),
+            service_name=self.localised('ServiceName', service_name),
+            player=1 if player else 0,
+            initial_rv='\n'.join('<e d:type="cDeltaString">%s</e>' % vehicle for vehicle in vehicles),
+            container_id=self.id(),
+            instructions='\n'.join(instructions),
+        )
+
+    def guid(self):
+        return str(uuid.UUID(int=self.random.getrandbits(128)))
+
+    def id(self):
+        self.next_id += 1
+        return self.next_id
+
+    def localised(self, tag, text):
+        return LOCALISED.format(tag=tag, text=escape(text), key=self.guid())
+
+    def route(self, route_number):
+        return ROUTE_PROPERTIES.format(
+            uuid0=self.random.getrandbits(63),
+            uuid1=self.random.getrandbits(63),
+            devstring=self.guid(),
+            display_name=self.localised('DisplayName', 'Synthetic Route %d' % route_number),
+        )
+
+    def scenario_class(self):
+        classes, weights = zip(*SCENARIO_CLASSES)
+        return self.random.choices(classes, weights)[0]
+
+    def service_name(self):
+        return '%d%s%02d' % (self.random.randint(1, 9), self.random.choice('ABCDFHJKLNPSUY'), self.random.randint(0, 99))
+
+    def write(self, path, content):
+        if not isinstance(content, bytes):
+            content = content.encode('utf-8')
+        with open(path, 'wb') as f:
+            f.write(content)
+
+    def write_scenario(self, folder, scenario_guid, route_number, scenario_number):
+        service_name = self.service_name()
+        properties = SCENARIO_PROPERTIES.format(
+            uuid0=self.random.getrandbits(63),
+            uuid1=self.random.getrandbits(63),
+            devstring=scenario_guid,
+            display_name=self.localised('DisplayName', 'Synthetic %d/%d' % (route_number, scenario_number)),
+            description=self.localised('Description', 'Lorem ipsum dolor sit amet ' * 10),
+            briefing=self.localised('Briefing', 'Sed ut perspiciatis unde omnis ' * 20),
+            start_location=self.localised('StartLocation', self.random.choice(STATIONS)),
+            scenario_class=self.scenario_class(),
+            start_time=self.random.randint(4 * 3600, 22 * 3600),
+            duration=self.random.choice((15, 20, 30, 30, 45, 45, 60, 60, 75, 90, 120, 150, 180)),
+            day=self.random.randint(1, 28),
+            month=self.random.randint(1, 12),
+            year=self.random.randint(1960, 2015),
+            service_name=self.localised('ServiceName', service_name),
+        )
+        self.write(os.path.join(folder, 'ScenarioProperties.xml'), properties)
+
+        player_position = self.random.randrange(self.consists)
+        consists = '\n'.join(
+            self.consist(n == player_position, service_name if n == player_position else self.service_name())
+            for n in range(self.consists)
+        )
+        scenario = SCENARIO.format(consists=consists)
+        if self.random.random() < self.missing_scenario_xml:
+            # only the packed version is present
+            self.write(os.path.join(folder, 'Scenario.bin'), serz(scenario))
+        else:
+            self.write(os.path.join(folder, 'Scenario.xml'), scenario)
+
+
+class SerzWriter(object):
+    """
+    Encodes XML the way Serz.exe packs it into .bin files, as read by dispatcher.SerzReader.
+
+    Record definitions and strings seen before are referred to instead of being repeated,
+    so that the caches of the reader are exercised.
+    """
+
+    def __init__(self):
+        self.chunks = [SERZ_MAGIC, struct.pack('<I', 0x00010000)]
+        self.definitions = {}
+        self.slots = [None] * SERZ_DEFINITION_SLOTS
+        self.next_slot = 0
+        self.strings = {}
+
+    def element(self, element):
+        attributes = dict((key.replace(DELTA, ''), value) for key, value in element.attrib.items())
+        text = (element.text or '').strip()
+        if 'numElements' in attributes:
+            values = text.split()
+            self.record('A', element.tag, attributes['elementType'])
+            self.chunks.append(struct.pack('<B', len(values)))
+            for value in values:
+                self.value(attributes['elementType'], value)
+        elif attributes.get('type') == 'ref':
+            self.record('R', element.tag)
+            self.chunks.append(struct.pack('<I', int(text)))
+        elif 'type' in attributes:
+            self.record('V', element.tag, attributes['type'])
+            self.value(attributes['type'], text)
+        elif len(element) or 'id' in attributes:
+            self.record('P', element.tag)
+            self.chunks.append(struct.pack('<II', int(attributes.get('id', 0)), len(element)))
+            for child in element:
+                self.element(child)
+            self.record('p', element.tag)
+        else:
+            self.record('N', element.tag)
+
+    def encode(self, xml_text):
+        self.element(xml.etree.ElementTree.fromstring(xml_text.encode('utf-8')))
+        return b''.join(self.chunks)
+
+    def record(self, kind, name, value_type=None):
+        definition = (kind, name, value_type)
+        slot = self.definitions.get(definition)
+        if slot is not None:
+            self.chunks.append(struct.pack('<B', slot))
+            return
+        self.chunks.append(b'\xff' + kind.encode('ascii'))
+        self.string(name)
+        if value_type is not None:
+            self.string(value_type)
+        self.definitions.pop(self.slots[self.next_slot], None)
+        self.slots[self.next_slot] = definition
+        self.definitions[definition] = self.next_slot
+        self.next_slot = (self.next_slot + 1) % SERZ_DEFINITION_SLOTS
+
+    def string(self, string):
+        position = self.strings.get(string)
+        if position is not None:
+            self.chunks.append(struct.pack('<H', position))
+            return
+        encoded = string.encode('utf-8')
+        self.chunks.append(struct.pack('<HI', 0xFFFF, len(encoded)) + encoded)
+        self.strings[string] = len(self.strings)
+
+    def value(self, value_type, text):
+        if value_type == 'cDeltaString':
+            self.string(text)
+        elif value_type in ('sFloat32', 'sFloat64'):
+            self.chunks.append(struct.pack('<' + SERZ_VALUE_FORMATS[value_type], float(text)))
+        else:
+            self.chunks.append(struct.pack('<' + SERZ_VALUE_FORMATS[value_type], int(text)))
+
+
+def add_arguments(parser):
+    parser.add_argument('--routes', type=int, default=5)
+    parser.add_argument('--scenarios', type=int, default=20, help='scenarios per route')
+    parser.add_argument('--consists', type=int, default=10, help='consists per Scenario.xml')
+    parser.add_argument('--instructions', type=int, default=8, help='driver instructions of the player')
+    parser.add_argument('--vehicles', type=int, default=6, help='rail vehicles per consist')
+    parser.add_argument('--padding', type=int, default=0,
+                        help='bytes of padding per rail vehicle, to inflate Scenario.xml')
+    parser.add_argument('--missing-route', type=float, default=0.0,
+                        help='ratio of routes without RouteProperties.xml')
+    parser.add_argument('--missing-scenario-xml', type=float, default=0.0,
+                        help='ratio of scenarios shipping Scenario.bin only')
+    parser.add_argument('--duplicates', type=float, default=0.0,
+                        help='ratio of scenarios copied from another route with the same GUID')
+    parser.add_argument('--seed', type=int, default=1)
+
+
+def generator_from_args(target, args):
+    return Generator(
+        target, routes=args.routes, scenarios=args.scenarios, consists=args.consists,
+        instructions=args.instructions, vehicles=args.vehicles, padding=args.padding,
+        missing_route=args.missing_route, missing_scenario_xml=args.missing_scenario_xml,
+        duplicates=args.duplicates, seed=args.seed,
+    )
+
+
+def parse_args(args=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Railworks Content/Routes tree.')
+    parser.add_argument('target', help='folder to become the Railworks folder')
+    add_arguments(parser)
+    return parser.parse_args(args)
+
+
+def serz(xml_text):
+    """
+    Scenario.bin in the Serz format holding xml_text
+    """
+    return SerzWriter().encode(xml_text)
+
+
+def main():
+    args = parse_args()
+    generated = generator_from_args(args.target, args).generate()
+    print('Generated %d scenario(s) in %s' % (len(generated), args.target))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+import os
+import sys
+import zipfile
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import dispatcher  # noqa: E402
+
+
+def test_broken_package_next_to_valid_one(tmp_path):
+    route_folder = tmp_path / 'Content' / 'Routes' / 'route'
+    route_folder.mkdir(parents=True)
+    with zipfile.ZipFile(str(route_folder / 'Valid.ap'), 'w') as package:
+        package.writestr('Scenarios/scenario/ScenarioProperties.xml', '<cScenarioProperties/>')
+    (route_folder / 'Broken.ap').write_bytes(b'garbage\n')
+    archives = sorted(str(path) for path in route_folder.glob('*.ap'))
+
+    content = dispatcher.ContentSource()
+    scenario_xml = os.path.join(str(route_folder), 'Scenarios', 'scenario', 'ScenarioProperties.xml')
+    pattern = os.path.join(str(tmp_path), 'Content', 'Routes', '*', 'Scenarios', '*', 'ScenarioProperties.xml')
+    assert content.packed(pattern, archives) == [scenario_xml]
+    with content.open(scenario_xml) as f:
+        assert f.read() == b'<cScenarioProperties/>'
+    assert not content.exists(os.path.join(str(route_folder), 'Scenarios', 'scenario', 'Scenario.bin'))
+    content.reset()
+
+
+def test_scenario_replaced_in_its_folder_is_walked_again(tmp_path):
+    scenario_folder = tmp_path / 'Routes' / 'route' / 'Scenarios' / 'scenario'
+    scenario_folder.mkdir(parents=True)
+    scenario_xml = scenario_folder / 'ScenarioProperties.xml'
+    scenario_xml.write_text('<cScenarioProperties/>')
+
+    index = dispatcher.ScenarioIndex(str(tmp_path / 'dispatcher.sqlite'))
+    scanner = dispatcher.ContentScanner(index, jobs=1)
+    assert scanner.scan(str(tmp_path / 'Routes'))[1][str(scenario_xml)][1] == len('<cScenarioProperties/>')
+
+    # written next to it and moved over it, the way updates usually replace files
+    replacement = scenario_folder / 'ScenarioProperties.xml.tmp'
+    replacement.write_text('<cScenarioProperties>updated</cScenarioProperties>')
+    os.replace(str(replacement), str(scenario_xml))
+    os.utime(str(scenario_folder), ns=(0, os.stat(str(scenario_folder)).st_mtime_ns + 1))
+    assert scanner.scan(str(tmp_path / 'Routes'))[1][str(scenario_xml)][1] == len(
+        '<cScenarioProperties>updated</cScenarioProperties>')
+    index.close()
@@ -0,0 +1,52 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import dispatcher  # noqa: E402
+
+
+class Record(object):
+
+    def __init__(self, duration, devstring=None):
+        self.duration = duration
+        self.devstring = devstring or 'scenario-%d' % duration
+
+
+def solve(durations, span, seed=1):
+    solver = dispatcher.DurationSolver(
+        [Record(duration, 'scenario-%d' % n) for n, duration in enumerate(durations)], span,
+        rng=random.Random(seed))
+    picked = solver.solve()
+    return picked and sorted(record.duration for record in picked)
+
+
+def test_single_scenario_as_long_as_requested():
+    assert solve([30], dispatcher.parse_work_orders('30m')) == [30]
+
+
+@pytest.mark.parametrize('duration, expected', [(15, [15]), (45, [45]), (14, None), (46, None)])
+def test_span_ends_are_included(duration, expected):
+    assert solve([duration], (15, 45)) == expected
+
+
+def test_break_only_between_scenarios():
+    # 20 + 15 minutes of break + 20
+    assert solve([20, 20], (55, 55)) == [20, 20]
+    assert solve([20, 20], (56, 70)) is None
+
+
+def test_picks_stay_within_span():
+    durations = [15, 20, 30, 45, 60, 90, 120] * 3
+    for seed in range(50):
+        picked = solve(durations, (105, 135), seed)
+        total = sum(picked) + dispatcher.BREAK_LENGTH * (len(picked) - 1)
+        assert 105 <= total <= 135
+
+
+def test_unreachable_span_is_reported():
+    with pytest.raises(dispatcher.DispatcherError) as error:
+        dispatcher.select_orders([Record(60), Record(90)], (15, 45), index=None)
+    assert str(error.value) == 'No combination of scenarios lasts between 15 and 45 minutes. Sorry.'
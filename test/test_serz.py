@@ -0,0 +1,121 @@
+import os
+import struct
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)))
+import dispatcher  # noqa: E402
+
+
+def string(text):
+    """
+    A string stored for the first time
+    """
+    data = text.encode('utf-8')
+    return b'\xff\xff' + struct.pack('<I', len(data)) + data
+
+
+def stored(position):
+    """
+    A string stored before, referred to by position
+    """
+    return struct.pack('<H', position)
+
+
+def element_id(value):
+    return struct.pack('<II', value, 0)
+
+
+# cRecordSet > Record > an AI consist and the player consist, the second one reusing definition slots:
+#   0 cRecordSet, 1 Record, 2 cConsist, 3 Driver, 4 cDriver, 5 PlayerDriver, 6 /cDriver, 7 /Driver,
+#   8 /cConsist, 9 ServiceName, 10 Scale, 11 Follower, 12 Other, 13 MaxPermissibleSpeed, 14 /Record,
+#   15 /cRecordSet
+# strings: 0 cRecordSet, 1 Record, 2 cConsist, 3 Driver, 4 cDriver, 5 PlayerDriver, 6 bool,
+#   7 ServiceName, 8 cDeltaString, 9 1A01, 10 Scale, 11 sFloat32, 12 Follower, 13 Other,
+#   14 MaxPermissibleSpeed
+SCENARIO_BIN = b''.join([
+    dispatcher.SERZ_MAGIC, struct.pack('<I', 0x00010000),
+    b'\xffP', string('cRecordSet'), element_id(1),
+    b'\xffP', string('Record'), element_id(0),
+    b'\xffP', string('cConsist'), element_id(10),
+    b'\xffP', string('Driver'), element_id(0),
+    b'\xffP', string('cDriver'), element_id(11),
+    b'\xffV', string('PlayerDriver'), string('bool'), b'\x00',
+    b'\xffp', stored(4),
+    b'\xffp', stored(3),
+    b'\xffp', stored(2),
+    b'\x02', element_id(20),
+    b'\x03', element_id(0),
+    b'\x04', element_id(21),
+    b'\xffV', string('ServiceName'), string('cDeltaString'), string('1A01'),
+    b'\x05', b'\x01',
+    b'\xffA', string('Scale'), string('sFloat32'), b'\x02', struct.pack('<ff', 1.0, 0.5),
+    b'\xffR', string('Follower'), struct.pack('<I', 10),
+    b'\xffN', string('Other'),
+    b'\x06',
+    b'\x07',
+    b'\xffV', string('MaxPermissibleSpeed'), stored(11), struct.pack('<f', 44.7),
+    b'\x08',
+    b'\xffp', stored(1),
+    b'\xffp', stored(0),
+])
+
+PLAYER_CONSIST = {
+    '@d:id': '20',
+    'Driver': {
+        'cDriver': {
+            '@d:id': '21',
+            'ServiceName': {'@d:type': 'cDeltaString', '#text': '1A01'},
+            'PlayerDriver': {'@d:type': 'bool', '#text': '1'},
+            'Scale': {
+                '@d:numElements': '2', '@d:elementType': 'sFloat32', '@d:precision': 'string', '#text': '1 0.5',
+            },
+            'Follower': {'@d:type': 'ref', '#text': '10'},
+            'Other': None,
+        },
+    },
+    'MaxPermissibleSpeed': {'@d:type': 'sFloat32', '@d:precision': 'string', '#text': '44.7'},
+}
+
+
+@pytest.fixture
+def scenario_bin(tmp_path):
+    def write(data):
+        path = tmp_path / 'Scenario.bin'
+        path.write_bytes(data)
+        return str(path)
+    return write
+
+
+def test_player_consist(scenario_bin):
+    assert dispatcher.parse_player_consist(scenario_bin(SCENARIO_BIN)) == PLAYER_CONSIST
+
+
+@pytest.mark.parametrize('data', [
+    SCENARIO_BIN[:-20],
+    SCENARIO_BIN.replace(b'\x06\x07', b'\x06\x20'),
+    SCENARIO_BIN.replace(b'\xffR', b'\xffZ'),
+])
+def test_broken_file_raises(scenario_bin, data):
+    with pytest.raises((ValueError, struct.error, KeyError, IndexError)):
+        dispatcher.parse_player_consist(scenario_bin(data))
+
+
+def test_converter_falls_back(scenario_bin, tmp_path):
+    xml_bin = scenario_bin(SCENARIO_BIN[:-20])
+    xml_detailed = xml_bin[:-len('.bin')] + '.xml'
+    command = '"%s" -c "open(\'{xml}\', \'w\').write(\'<cRecordSet/>\')"' % sys.executable
+    converter = dispatcher.Converter(str(tmp_path), command=command, native=True)
+    assert converter.submit(xml_detailed) is None
+    assert converter.fallback(xml_detailed)
+    assert dispatcher.scenario_source(xml_detailed) == xml_detailed
+    # Scenario.xml is read from now on, there is nothing left to fall back from
+    assert not converter.fallback(xml_detailed)
+
+
+def test_native_only_without_converter(tmp_path):
+    assert dispatcher.is_command_available(str(tmp_path), '"%s" -c pass {bin}' % sys.executable)
+    assert not dispatcher.is_command_available(str(tmp_path), dispatcher.CONVERTER_COMMAND)
+    (tmp_path / 'Serz.exe').write_bytes(b'')
+    assert dispatcher.is_command_available(str(tmp_path), 'Serz.exe {bin}')